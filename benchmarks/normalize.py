@@ -0,0 +1,82 @@
+"""
+Compare runtime and peak memory of preprocess.normalize() with the previous
+merge-based implementation on synthetic vital data.
+
+Run from the root of the repository:
+
+    poetry run python benchmarks/normalize.py [number of rows]
+"""
+import sys
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+from long_covid import schema
+from long_covid.preprocess import normalize
+
+
+N_ROWS = 20_000_000
+
+
+def synthetic_vitals(n_rows, seed=0):
+    """
+    Vital data of roughly the size of the production data: 120,000 users,
+    two years of daily data, three vitals and 30 devices.
+    """
+    rng = np.random.default_rng(seed)
+
+    df = pd.DataFrame({
+        'userid': rng.integers(0, 120_000, n_rows),
+        'date': pd.Timestamp('2020-04-01') + pd.to_timedelta(rng.integers(0, 730, n_rows), unit='D'),
+        'vitalid': rng.choice([9, 43, 65], n_rows),
+        'value': rng.normal(5000, 2000, n_rows),
+        'deviceid': rng.integers(0, 30, n_rows)
+    })
+
+    return schema.enforce(df, schema.VITALS)
+
+
+def normalize_with_merge(df, by=['vitalid', 'date', 'deviceid']):
+
+    norm = df.groupby(by)[['value']].mean().rename(columns={'value': 'daily_mean'})
+    norm.reset_index(inplace=True)
+    df = pd.merge(df, norm, on=by)
+    df['normalized_value'] = df['value'] - df['daily_mean']
+    df.rename(columns={'value': 'raw_value'}, inplace=True)
+    df.rename(columns={'normalized_value': 'value'}, inplace=True)
+
+    return df
+
+
+def measure(label, function, df):
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = function(df)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    print(f'{label:>18}: {elapsed:6.2f}s, peak memory {peak / 1E6:8.1f} MB')
+
+    return result
+
+
+def main(n_rows):
+
+    df = synthetic_vitals(n_rows)
+    print(f'{n_rows} rows, {schema.memory_usage(df):.1f} MB')
+
+    expected = measure('merge', normalize_with_merge, df)
+    for method in ('mean', 'median', 'trimmed'):
+        result = measure(f'normalize {method}', lambda df: normalize(df, method=method), df)
+
+    result = normalize(df)
+    keys = ['userid', 'date', 'vitalid', 'deviceid', 'raw_value']
+    expected = expected.sort_values(keys).reset_index(drop=True)
+    result = result.sort_values(keys).reset_index(drop=True)
+    print('Max. deviation from merge-based result:', np.abs(expected.daily_mean - result.daily_mean).max())
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else N_ROWS)
@@ -0,0 +1,70 @@
+"""
+Compare the runtime of parsing vaccination and test dates with the
+vectorized parsers in surveydataIO and with the previous per-row parsing.
+
+Run from the root of the repository:
+
+    poetry run python benchmarks/survey_dates.py [number of rows]
+"""
+import sys
+import time
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from long_covid.surveydataIO import _convert_date, _convert_dates
+
+
+N_ROWS = 200_000
+
+MONTHS = [
+    'Januar', 'Februar', 'März', 'April', 'Mai', 'Juni',
+    'Juli', 'August', 'September', 'Oktober', 'November', 'Dezember'
+]
+
+
+def synthetic_dates(n_rows, seed=0):
+    """
+    Vaccination dates as 'MONTH YEAR' strings with 10% missing values and
+    test dates as week intervals like in the one-off survey.
+    """
+    rng = np.random.default_rng(seed)
+
+    months = [f'{month} {year}' for year in (2021, 2022) for month in MONTHS]
+    vaccination_dates = pd.Series(rng.choice(months, n_rows), dtype=object)
+    vaccination_dates[rng.random(n_rows) < 0.1] = np.nan
+
+    mondays = pd.date_range('2020-03-02', '2022-03-28', freq='7D')
+    starts = mondays[rng.integers(0, len(mondays), n_rows)]
+    test_dates = pd.Series([
+        f'{start:%d.%m.%Y} - {start + pd.Timedelta(days=6):%d.%m.%Y}' for start in starts
+    ])
+
+    return vaccination_dates, test_dates
+
+
+def measure(label, function, data):
+
+    start = time.perf_counter()
+    result = function(data)
+    elapsed = time.perf_counter() - start
+    print(f'{label:>24}: {elapsed:6.3f}s')
+
+    return result, elapsed
+
+
+def main(n_rows):
+
+    vaccination_dates, test_dates = synthetic_dates(n_rows)
+    print(f'{n_rows} rows')
+
+    expected, before = measure('vaccinations apply', lambda s: s.apply(_convert_date), vaccination_dates)
+    result, after = measure('vaccinations factorized', _convert_dates, vaccination_dates)
+    print(f'Speedup: {before / after:.0f}x, identical: {pd.to_datetime(expected).equals(result)}')
+
+    expected, before = measure('tests strptime', lambda s: pd.Series([datetime.strptime(text[:10], '%d.%m.%Y') for text in s]), test_dates)
+    result, after = measure('tests to_datetime', lambda s: pd.to_datetime(s.str[:10], format='%d.%m.%Y'), test_dates)
+    print(f'Speedup: {before / after:.0f}x, identical: {expected.equals(result)}')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else N_ROWS)
@@ -0,0 +1,47 @@
+"""
+Compare the throughput of the two loaders for vital data in load_from_db.
+
+Requires database access (see the setup section in the README). Run from the
+root of the repository:
+
+    poetry run python benchmarks/vitals_loader.py
+"""
+import time
+from long_covid import load_from_db
+
+
+N_USERS = 2000
+REPETITIONS = 3
+
+
+def sample_user_ids(n_users):
+
+    query = """SELECT DISTINCT user_id FROM datenspende.vitaldata LIMIT %(n_users)s"""
+
+    return load_from_db.run_query(query, {'n_users': n_users}).user_id.values
+
+
+def benchmark(user_ids, method, repetitions):
+
+    best = None
+    for _ in range(repetitions):
+        start = time.perf_counter()
+        vitals = load_from_db.get_vitals(user_ids, method=method)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    memory = vitals.memory_usage(deep=True).sum() / 1E6
+    print(f'{method:>6}: {len(vitals):>10} rows in {best:7.2f}s, {len(vitals) / best:12.0f} rows/s, {memory:8.1f} MB')
+
+
+def main():
+
+    user_ids = sample_user_ids(N_USERS)
+    print('Loading vital data for', len(user_ids), 'users...')
+
+    for method in ('query', 'copy'):
+        benchmark(user_ids, method, REPETITIONS)
+
+
+if __name__ == '__main__':
+    main()
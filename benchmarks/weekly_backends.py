@@ -0,0 +1,84 @@
+"""
+Compare the runtime of weekly aggregates and deviations with the 'pandas'
+and 'numpy' backends of compute and check that both give exactly the same
+result, also for inputs that are empty or filtered out entirely.
+
+Run from the root of the repository:
+
+    poetry run python benchmarks/weekly_backends.py [number of rows]
+"""
+from pathlib import Path
+import sys
+import tempfile
+import time
+import pandas as pd
+from long_covid.compute import deviations_from_weekly, process_shards, weekly_aggregates
+from weekly_binning import synthetic_data
+
+
+N_ROWS = 2_000_000
+N_USERS = 500
+
+
+def agree(label, pandas_result, numpy_result):
+
+    try:
+        pd.testing.assert_frame_equal(pandas_result.reset_index(drop=True), numpy_result.reset_index(drop=True), check_exact=True)
+        same = True
+    except AssertionError:
+        same = False
+    print(f'{label:>40}: same result: {same} ({len(numpy_result)} rows)')
+
+    return same
+
+
+def measure(label, function, *args, **kwargs):
+
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    print(f'{label:>40}: {time.perf_counter() - start:6.2f}s')
+
+    return result
+
+
+def main(n_rows):
+
+    vitals, tests = synthetic_data(n_rows, N_USERS)
+    print(f'{n_rows} rows')
+
+    weekly = {
+        backend: measure(f'weekly aggregates ({backend})', weekly_aggregates, vitals, tests, backend=backend)
+        for backend in ('pandas', 'numpy')
+    }
+    checks = [agree('weekly aggregates', weekly['pandas'], weekly['numpy'])]
+
+    for min_points_per_week in (6, 1000):
+        checks.append(agree(
+            f'deviations (min_points_per_week={min_points_per_week})',
+            deviations_from_weekly(weekly['pandas'], min_points_per_week, 3, backend='pandas'),
+            deviations_from_weekly(weekly['numpy'], min_points_per_week, 3, backend='numpy')
+        ))
+
+    # No vital data at all
+    empty = vitals.iloc[:0]
+    checks.append(agree(
+        'weekly aggregates (no vital data)',
+        weekly_aggregates(empty, tests, backend='pandas'),
+        weekly_aggregates(empty, tests, backend='numpy')
+    ))
+
+    # Shards without users (all user ids are even)
+    even = vitals[vitals.userid % 2 == 0].reset_index(drop=True)
+    with tempfile.TemporaryDirectory() as directory:
+        vitals_file, tests_file = Path(directory) / 'vitals.feather', Path(directory) / 'tests.feather'
+        even.to_feather(vitals_file)
+        tests.to_feather(tests_file)
+
+        weekly_even, _, _ = process_shards(n_jobs=4, backend='numpy', vitals_file=vitals_file, tests_file=tests_file)
+        checks.append(agree('weekly aggregates (empty shards)', weekly_aggregates(even, tests, backend='pandas'), weekly_even))
+
+    print('Backends agree:', all(checks))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else N_ROWS)
@@ -0,0 +1,84 @@
+"""
+Compare the size of intermediate data, runtime and peak memory of selecting
+vital data around each user's test with compute.windowed_vitals() and with
+the previous merge of vital and test data.
+
+Run from the root of the repository:
+
+    poetry run python benchmarks/weekly_binning.py [number of rows]
+"""
+import sys
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+from long_covid import schema
+from long_covid.compute import windowed_vitals
+
+
+N_ROWS = 20_000_000
+N_USERS = 20_000
+
+
+def synthetic_data(n_rows, n_users, seed=0):
+
+    rng = np.random.default_rng(seed)
+
+    vitals = pd.DataFrame({
+        'userid': rng.integers(0, n_users, n_rows),
+        'date': pd.Timestamp('2020-04-01') + pd.to_timedelta(rng.integers(0, 730, n_rows), unit='D'),
+        'vitalid': rng.choice([9, 43, 65], n_rows),
+        'value': rng.normal(0, 2000, n_rows),
+        'deviceid': rng.integers(0, 30, n_rows)
+    })
+
+    tests = pd.DataFrame({
+        'user_id': np.arange(n_users),
+        'test_result': rng.choice(['negative', 'positive'], n_users),
+        'test_date': pd.Timestamp('2020-04-01') + pd.to_timedelta(rng.integers(0, 730, n_users), unit='D')
+    })
+
+    return schema.enforce(vitals, schema.VITALS), schema.enforce(tests, schema.TESTS)
+
+
+def window_with_merge(vitals, tests):
+
+    df = pd.merge(vitals, tests, left_on='userid', right_on='user_id')
+    print(f'{"merged rows":>18}: {len(df)}')
+
+    df['weeks_since_test'] = (df.date - df.test_date).dt.days // 7
+    df = df[df.weeks_since_test.between(-8, 20)]
+
+    return df
+
+
+def measure(label, function, *args):
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = function(*args)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    print(f'{label:>18}: {elapsed:6.2f}s, peak memory {peak / 1E6:8.1f} MB, {len(result)} rows in window')
+
+    return result
+
+
+def main(n_rows):
+
+    vitals, tests = synthetic_data(n_rows, N_USERS)
+    print(f'{n_rows} rows, {schema.memory_usage(vitals):.1f} MB')
+
+    expected = measure('merge', window_with_merge, vitals, tests)
+    result = measure('windowed_vitals', windowed_vitals, vitals, tests)
+
+    keys = ['userid', 'vitalid', 'weeks_since_test', 'value']
+    expected = expected[keys].sort_values(keys).reset_index(drop=True)
+    result = result[keys].sort_values(keys).reset_index(drop=True)
+    print('Identical selection:', expected.astype(result.dtypes).equals(result))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else N_ROWS)
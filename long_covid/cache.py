@@ -0,0 +1,226 @@
+"""
+Content-addressed cache for the stages of the pipeline.
+
+The outputs of a stage are stored under a key that is the hash of the
+contents of its input files, its parameters and the source code of the
+modules it depends on. If a stage is run again with the same key, its
+outputs are restored from the cache instead of being recomputed.
+
+The cache is kept below a disk budget by evicting the least recently used
+entries.
+"""
+from datetime import datetime
+from pathlib import Path
+import hashlib
+import json
+import shutil
+from long_covid import profiling
+
+
+CACHE_DIR = 'data/.cache'
+HASH_INDEX = 'hashes.json'
+ENTRY_FILE = 'entry.json'
+
+# Disk budget of the cache in bytes
+BUDGET = 20 * 2**30
+
+
+def add_arguments(parser):
+    """
+    Add the command line options of the cache to an argparse.ArgumentParser.
+    """
+    parser.add_argument('--force', action='store_true', help='recompute the stage even if a cached result exists')
+    parser.add_argument('--cache-budget', type=float, default=BUDGET / 2**30, help='disk budget of the stage cache in GB')
+
+
+def run_cached(name, function, kwargs, inputs, outputs, sources, params=None, unkeyed=(), force=False, budget=BUDGET, cache_dir=CACHE_DIR):
+    """
+    Run a stage of the pipeline unless its outputs are cached.
+
+    Args:
+        name (str): Name of the stage, e.g., 'preprocess'.
+        function (callable): The stage, e.g., preprocess.main.
+        kwargs (dict): Keyword arguments of function.
+        inputs (list of str): Files or directories the stage reads.
+        outputs (list of str): Files or directories the stage writes.
+        sources (list of str): Source files of the stage and the modules it depends on.
+        params (dict, optional): Further parameters that determine the
+            outputs, e.g., module level constants. Defaults to None.
+        unkeyed (list of str, optional): Keyword arguments of function that
+            do not change the outputs, e.g., 'n_jobs'. They are left out of
+            the key. Defaults to ().
+        force (bool, optional): Run the stage even on a cache hit. Defaults to False.
+        budget (int, optional): Disk budget of the cache in bytes. Defaults to BUDGET.
+        cache_dir (str, optional): Directory of the cache. Defaults to CACHE_DIR.
+
+    Returns:
+        bool: True if the outputs were restored from the cache.
+    """
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+
+    index = _load_index(cache_dir)
+    keyed = {name: value for name, value in kwargs.items() if name not in unkeyed}
+    key = stage_key(name, {**(params or {}), **keyed}, inputs, sources, index)
+    entry = cache_dir / key
+
+    hit = not force and (entry / ENTRY_FILE).exists()
+    if hit:
+        print(f'Restoring outputs of stage {name} from cache entry {key[:12]}')
+        # Recorded in place of the stage, which does not run
+        with profiling.stage(name) as record:
+            record['cached'] = True
+            _restore(entry, index)
+    else:
+        function(**kwargs)
+        _store(entry, name, outputs, index)
+
+    _save_index(index, cache_dir)
+    evict(budget, cache_dir, keep=key)
+
+    return hit
+
+
+def stage_key(name, params, inputs, sources, index=None):
+    """
+    Hash of the name of a stage, its parameters, the contents of its inputs
+    and its source code.
+    """
+    digest = hashlib.sha256()
+    digest.update(name.encode())
+    digest.update(json.dumps(params, sort_keys=True, default=str).encode())
+    for path in sorted(inputs) + sorted(sources):
+        digest.update(str(path).encode())
+        digest.update(content_hash(path, index).encode())
+
+    return digest.hexdigest()
+
+
+def content_hash(path, index=None):
+    """
+    SHA-256 of the contents of a file or of all files in a directory.
+
+    Hashes are remembered in index by path, size and modification time so
+    that large input files are only read again when they change.
+
+    Returns:
+        str: The hash or 'missing' if path does not exist.
+    """
+    path = Path(path)
+    if not path.exists():
+        return 'missing'
+
+    if path.is_dir():
+        digest = hashlib.sha256()
+        for child in sorted(p for p in path.rglob('*') if p.is_file()):
+            digest.update(str(child.relative_to(path)).encode())
+            digest.update(content_hash(child, index).encode())
+        return digest.hexdigest()
+
+    stat = path.stat()
+    signature = [stat.st_size, stat.st_mtime_ns]
+    if index is not None and index.get(str(path), {}).get('signature') == signature:
+        return index[str(path)]['hash']
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as infile:
+        for block in iter(lambda: infile.read(2**20), b''):
+            digest.update(block)
+
+    if index is not None:
+        index[str(path)] = {'signature': signature, 'hash': digest.hexdigest()}
+
+    return digest.hexdigest()
+
+
+def evict(budget=BUDGET, cache_dir=CACHE_DIR, keep=None):
+    """
+    Remove the least recently used cache entries until the cache fits into
+    the disk budget.
+
+    Args:
+        budget (int, optional): Disk budget in bytes. Defaults to BUDGET.
+        cache_dir (str, optional): Directory of the cache. Defaults to CACHE_DIR.
+        keep (str, optional): Key of an entry that is never removed. Defaults to None.
+    """
+    entries = []
+    for entry_file in Path(cache_dir).glob(f'*/{ENTRY_FILE}'):
+        with open(entry_file) as infile:
+            entry = json.load(infile)
+        entries.append((entry['last_used'], entry['size'], entry_file.parent))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, entry in sorted(entries):
+        if total <= budget:
+            break
+        if entry.name == keep:
+            continue
+        print(f'Evicting cache entry {entry.name[:12]} ({size / 1E6:.1f} MB)')
+        shutil.rmtree(entry)
+        total -= size
+
+
+def _store(entry, name, outputs, index):
+
+    shutil.rmtree(entry, ignore_errors=True)
+    entry.mkdir(parents=True)
+
+    files = []
+    size = 0
+    for i, output in enumerate(outputs):
+        output = Path(output)
+        copy = entry / str(i)
+        if output.is_dir():
+            shutil.copytree(output, copy)
+            size += sum(p.stat().st_size for p in copy.rglob('*') if p.is_file())
+        else:
+            shutil.copy2(output, copy)
+            size += copy.stat().st_size
+        files.append({'path': str(output), 'copy': str(i), 'hash': content_hash(output, index)})
+
+    _write_entry(entry, {'stage': name, 'outputs': files, 'size': size, 'last_used': datetime.now().isoformat()})
+
+
+def _restore(entry, index):
+
+    with open(entry / ENTRY_FILE) as infile:
+        metadata = json.load(infile)
+
+    for output in metadata['outputs']:
+        path = Path(output['path'])
+
+        # Outputs that are still in place do not need to be copied again
+        if content_hash(path, index) == output['hash']:
+            continue
+
+        copy = entry / output['copy']
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if copy.is_dir():
+            shutil.rmtree(path, ignore_errors=True)
+            shutil.copytree(copy, path)
+        else:
+            shutil.copy2(copy, path)
+
+    metadata['last_used'] = datetime.now().isoformat()
+    _write_entry(entry, metadata)
+
+
+def _write_entry(entry, metadata):
+
+    with open(entry / ENTRY_FILE, 'w') as outfile:
+        json.dump(metadata, outfile, indent=4)
+
+
+def _load_index(cache_dir):
+
+    try:
+        with open(Path(cache_dir) / HASH_INDEX) as infile:
+            return json.load(infile)
+    except FileNotFoundError:
+        return {}
+
+
+def _save_index(index, cache_dir):
+
+    with open(Path(cache_dir) / HASH_INDEX, 'w') as outfile:
+        json.dump(index, outfile)
@@ -1,5 +1,15 @@
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import product, repeat
 from pathlib import Path
+import argparse
+from long_covid import cache, dataset, profiling, schema, sketches
+from long_covid.dataset import write_partitioned
+from long_covid.schema import COHORT_KEYS, in_cohort
 
 Path("data/03_derived").mkdir(parents=True, exist_ok=True)
 
@@ -13,8 +23,11 @@ def remove_unplausible_values(df, key='vital_change'):
     return df
 
 
-def compute_per_user_baseline(df, min_weeks):
+def compute_per_user_baseline(df, min_weeks, backend='pandas'):
     
+    if backend == 'numpy':
+        return _baseline_numpy(df, min_weeks)
+
     baseline = df[df.weeks_since_test < -1].groupby(['userid', 'vitalid'])[['value']].agg(['mean', 'count'])
     baseline = baseline[baseline['value']['count'] >= min_weeks]
     
@@ -24,46 +37,511 @@ def compute_per_user_baseline(df, min_weeks):
     return baseline
 
 
-def weekly_deviations(vitaldata, testdata, min_points_per_week, min_weeks_for_baseline):
+def weekly_means(df, backend='pandas'):
+    """
+    Average vital data per user, vital and week.
+
+    Args:
+        df (pandas.DataFrame): Vital data as returned by windowed_vitals().
+        backend (str, optional): Either 'pandas' to use groupby or 'numpy' to
+            use segmented reductions over a single sorted key. Defaults to 'pandas'.
+
+    Returns:
+        pandas.DataFrame: Columns userid, vitalid, weeks_since_test,
+        test_result, value (the weekly mean) and count (the number of data
+        points in that week), sorted by user, vital and week.
+    """
+    if backend == 'numpy':
+        return _weekly_means_numpy(df)
 
-    df = pd.merge(vitaldata, testdata, left_on='userid', right_on='user_id')
-    
-    df['weeks_since_test'] = (df.date - df.test_date).dt.days // 7
-    df = df[df.weeks_since_test.between(-8, 20)]
-    print('Number of users that donate at least one data point between -8 and 20 weeks around test:', len(df.userid.unique()))
-    
-    df = remove_unplausible_values(df, key='value')
-    print('Number of users after removal of unplausible values:', len(df.userid.unique()))
-    
     aggregations =  {'test_result': 'first', 'value': ['mean', 'count']}
     df = df.groupby(['userid', 'vitalid', 'weeks_since_test']).agg(aggregations)
-    df = df[df['value']['count'] >= min_points_per_week]
-    print(f'Number of users with at least one week of {min_points_per_week} data points:', len(df.reset_index().userid.unique()))
 
     # Reformat dataframe
     df.columns = df.columns.get_level_values(1)
     df.reset_index(inplace=True)
     df.rename(columns={'first': 'test_result', 'mean': 'value'}, inplace=True)
+
+    return df
+
+
+def _segments(key):
+    """
+    Sort an integer key and find the segments of equal values.
+
+    Returns:
+        tuple: The sort order (stable, so the first element of each segment
+        is the first occurrence in the input), the start of each segment in
+        the sorted key and the length of each segment. All three are empty
+        for an empty key.
+    """
+    order = np.argsort(key, kind='stable')
+    sorted_key = key[order]
+
+    if len(key) == 0:
+        return order, np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+
+    starts = np.flatnonzero(np.concatenate([[True], sorted_key[1:] != sorted_key[:-1]]))
+    counts = np.diff(np.append(starts, len(key)))
+
+    return order, starts, counts
+
+
+def _segment_means(values, starts, counts):
+    """
+    Mean of each segment of values with the same floating point operations as
+    pandas' groupby mean: a compensated (Kahan) sum in the dtype of values in
+    the order of the rows, divided by the number of rows. The k-th element of
+    all segments is added at once, so there are as many steps as elements in
+    the longest segment.
+    """
+    sums = np.zeros(len(starts), dtype=values.dtype)
+    compensation = np.zeros(len(starts), dtype=values.dtype)
+
+    for k in range(counts.max() if len(counts) else 0):
+        active = np.flatnonzero(counts > k)
+        y = values[starts[active] + k] - compensation[active]
+        t = sums[active] + y
+        compensation[active] = (t - sums[active]) - y
+        sums[active] = t
+
+    return sums / counts.astype(values.dtype)
+
+
+def _group_keys(values):
+    """
+    Keys of a groupby result have the dtype of a pandas Index built from the
+    values, e.g., int64 for int32 values in pandas < 2.
+    """
+    return pd.Index(values).values
+
+
+def _weekly_means_numpy(df):
+    """
+    Same as weekly_means() with backend='pandas' but computed by encoding
+    (userid, vitalid, week) into a single int64 key, sorting once and reducing
+    each segment of equal keys.
+    """
+    userid = df.userid.values.astype(np.int64)
+    weeks = df.weeks_since_test.values.astype(np.int64)
+    vital_codes, vitals = pd.factorize(df.vitalid.values, sort=True)
+
+    if len(df):
+        first_week, n_weeks = weeks.min(), weeks.max() - weeks.min() + 1
+    else:
+        first_week, n_weeks = 0, 1
+
+    key = (userid * len(vitals) + vital_codes) * n_weeks + (weeks - first_week)
+    order, starts, counts = _segments(key)
+    first = order[starts]
+
+    return pd.DataFrame({
+        'userid': _group_keys(df.userid.values[first]),
+        'vitalid': _group_keys(df.vitalid.values[first]),
+        'weeks_since_test': _group_keys(df.weeks_since_test.values[first]),
+        'test_result': df.test_result.take(first).values,
+        'value': _segment_means(df.value.values[order], starts, counts),
+        'count': counts
+    })
+
+
+def _baseline_numpy(df, min_weeks):
+    """
+    Same as compute_per_user_baseline() with backend='pandas' but computed
+    with segmented reductions. Expects weekly data sorted by user and vital
+    as returned by weekly_means().
+    """
+    df = df[df.weeks_since_test.values < -1]
+
+    userid = df.userid.values.astype(np.int64)
+    vital_codes, vitals = pd.factorize(df.vitalid.values, sort=True)
+
+    order, starts, counts = _segments(userid * max(len(vitals), 1) + vital_codes)
+    first = order[starts]
+
+    baseline = pd.DataFrame(
+        {'baseline': _segment_means(df.value.values[order], starts, counts), 'count': counts},
+        index=pd.MultiIndex.from_arrays([_group_keys(df.userid.values[first]), _group_keys(df.vitalid.values[first])], names=['userid', 'vitalid'])
+    )
+
+    return baseline[baseline['count'] >= min_weeks]
+
+
+def windowed_vitals(vitaldata, testdata, first_week=-8, last_week=20):
+    """
+    Select all vital data within a window of weeks around each user's test.
+
+    Instead of merging the vital data with the test data (which copies every
+    vital data point before most of them are dropped), each user's test date
+    is looked up in the sorted user ids of the test data. The weeks since the
+    test are computed in integer arithmetic and only data points inside the
+    window are materialized.
+
+    Args:
+        vitaldata (pandas.DataFrame): The processed vital data.
+        testdata (pandas.DataFrame): Test results and dates with one row per user.
+        first_week (int, optional): First week of the window. Defaults to -8.
+        last_week (int, optional): Last week of the window. Defaults to 20.
+
+    Returns:
+        pandas.DataFrame: Columns userid, vitalid, value, weeks_since_test and
+        test_result for all vital data points inside the window.
+    """
+    if testdata.user_id.duplicated().any():
+        raise ValueError('testdata must contain at most one test per user')
+
+    # Nothing to look up, but keep the columns and types of the result
+    if len(vitaldata) == 0 or len(testdata) == 0:
+        df = vitaldata[['userid', 'vitalid', 'value']].iloc[:0].copy()
+        df['weeks_since_test'] = np.array([], dtype=np.int64)
+        df['test_result'] = testdata.test_result.values[:0]
+        return df
+
+    order = np.argsort(testdata.user_id.values, kind='stable')
+    test_users = testdata.user_id.values[order]
+    test_dates = testdata.test_date.values[order].astype('datetime64[ns]')
+
+    userid = vitaldata.userid.values
+    position = np.searchsorted(test_users, userid)
+    position[position == len(test_users)] = 0
+
+    dates = vitaldata.date.values.astype('datetime64[ns]')
+    valid = (test_users[position] == userid) & ~np.isnat(test_dates[position]) & ~np.isnat(dates)
+
+    # Equivalent to (date - test_date).dt.days // 7
+    ns_per_day = 24 * 60 * 60 * 10**9
+    weeks = ((dates.view(np.int64) - test_dates[position].view(np.int64)) // ns_per_day) // 7
+
+    rows = np.flatnonzero(valid & (weeks >= first_week) & (weeks <= last_week))
+
+    df = vitaldata[['userid', 'vitalid', 'value']].take(rows)
+    df['weeks_since_test'] = weeks[rows]
+    df['test_result'] = testdata.test_result.take(order[position[rows]]).values
+
+    return df
+
+
+def _weekly_aggregates(vitaldata, testdata, backend='pandas'):
+    """
+    Helper for weekly_aggregates() that does not print anything so that it
+    can run in worker processes.
+
+    Returns:
+        tuple: The weekly aggregates (pandas.DataFrame) and a dict that maps a
+        description of each filter step to the number of remaining users.
+    """
+    attrition = {}
+
+    df = windowed_vitals(vitaldata, testdata, first_week=-8, last_week=20)
+    attrition['Number of users that donate at least one data point between -8 and 20 weeks around test:'] = len(df.userid.unique())
+    
+    df = remove_unplausible_values(df, key='value')
+    attrition['Number of users after removal of unplausible values:'] = len(df.userid.unique())
+    
+    return weekly_means(df, backend=backend), attrition
+
+
+@profiling.instrument()
+def weekly_aggregates(vitaldata, testdata, backend='pandas'):
+    """
+    Average vital data per user, vital and week between 8 weeks before and 20
+    weeks after each user's test.
+
+    This is the expensive part of computing weekly deviations. Its result
+    does not depend on any thresholds, so that it can be computed once and
+    reused for deviations with different thresholds, see
+    deviations_from_weekly() and sweep().
+
+    Args:
+        vitaldata (pandas.DataFrame): The processed vital data.
+        testdata (pandas.DataFrame): Test results and dates with one row per user.
+        backend (str, optional): Compute weekly means with 'pandas' groupby
+            or with 'numpy' segmented reductions, see weekly_means().
+            Defaults to 'pandas'.
+
+    Returns:
+        pandas.DataFrame: The weekly aggregates as returned by weekly_means().
+    """
+    df, attrition = _weekly_aggregates(vitaldata, testdata, backend)
+
+    for description, n_users in attrition.items():
+        profiling.remaining(description, n_users)
+
+    return df
+
+
+def _deviations_from_weekly(weekly, min_points_per_week, min_weeks_for_baseline, backend='pandas'):
+    """
+    Helper for deviations_from_weekly() that does not print anything so that
+    it can run in worker processes.
+
+    Returns:
+        tuple: The weekly deviations (pandas.DataFrame) and a dict that maps a
+        description of each filter step to the number of remaining users.
+    """
+    attrition = {}
+
+    df = weekly[weekly['count'] >= min_points_per_week]
+    attrition[f'Number of users with at least one week of {min_points_per_week} data points:'] = len(df.userid.unique())
     
-    baseline = compute_per_user_baseline(df, min_weeks=min_weeks_for_baseline)
-    print(f'Number of users with at least {min_weeks_for_baseline} weeks of baseline data:', len(baseline.reset_index().userid.unique()))
+    baseline = compute_per_user_baseline(df, min_weeks=min_weeks_for_baseline, backend=backend)
+    attrition[f'Number of users with at least {min_weeks_for_baseline} weeks of baseline data:'] = len(baseline.reset_index().userid.unique())
 
     df = pd.merge(df, baseline, on=['userid', 'vitalid'])
     df['vital_change'] = df['value'] - df.baseline
     
     df.drop(columns=['count_x', 'count_y', 'baseline', 'value'], inplace=True)
     
+    return schema.enforce(df, schema.WEEKLY_DEVIATIONS), attrition
+
+
+@profiling.instrument()
+def deviations_from_weekly(weekly, min_points_per_week, min_weeks_for_baseline, backend='pandas'):
+    """
+    Compute weekly deviations from each user's baseline from weekly aggregates.
+
+    Only weeks with at least min_points_per_week data points are considered.
+    The baseline is the average of all such weeks before the week prior to
+    the test and requires at least min_weeks_for_baseline weeks.
+
+    Args:
+        weekly (pandas.DataFrame): Weekly aggregates as returned by weekly_aggregates().
+        min_points_per_week (int): Minimum number of data points for a week to be considered.
+        min_weeks_for_baseline (int): Minimum number of weeks before the test to compute a baseline.
+        backend (str, optional): Compute baselines with 'pandas' or 'numpy'. Defaults to 'pandas'.
+
+    Returns:
+        pandas.DataFrame: The weekly deviations from the baseline per user, vital and week.
+    """
+    df, attrition = _deviations_from_weekly(weekly, min_points_per_week, min_weeks_for_baseline, backend)
+
+    for description, n_users in attrition.items():
+        profiling.remaining(description, n_users)
+
     return df
 
 
+@profiling.instrument()
+def weekly_deviations(vitaldata, testdata, min_points_per_week, min_weeks_for_baseline, backend='pandas'):
+    """
+    Compute weekly deviations of vital data from each user's baseline.
+
+    Args:
+        vitaldata (pandas.DataFrame): The processed vital data.
+        testdata (pandas.DataFrame): Test results and dates with one row per user.
+        min_points_per_week (int): Minimum number of data points for a week to be considered.
+        min_weeks_for_baseline (int): Minimum number of weeks before the test to compute a baseline.
+        backend (str, optional): Compute weekly means and baselines with
+            'pandas' groupby or with 'numpy' segmented reductions, see
+            weekly_means(). Defaults to 'pandas'.
+
+    Returns:
+        pandas.DataFrame: The weekly deviations from the baseline per user, vital and week.
+    """
+    weekly = weekly_aggregates(vitaldata, testdata, backend=backend)
+
+    return deviations_from_weekly(weekly, min_points_per_week, min_weeks_for_baseline, backend=backend)
+
+
+def _process_shard(shard, n_shards, backend, thresholds, lookup, summaries, vitals_file, tests_file):
+    """
+    Helper for process_shards() that runs the whole chain for the users of
+    one shard. It reads its users from the input files itself and does not
+    print anything so that it can run in worker processes.
+
+    Returns:
+        tuple: The weekly aggregates, the weekly deviations (None without
+        thresholds), the histograms and quantile sketches of the deviations
+        (None without summaries) and a dict that maps a description of each
+        filter step to the number of remaining users.
+    """
+    vitals, tests = load_inputs(shard, n_shards, vitals_file, tests_file, verbose=False)
+    weekly, attrition = _weekly_aggregates(vitals, tests, backend)
+    del vitals
+
+    if thresholds is None:
+        return weekly, None, None, attrition
+
+    df, deviation_attrition = _deviations_from_weekly(weekly, *thresholds, backend)
+    if lookup is not None:
+        df = add_cohort_mask(df, lookup)
+
+    shard_summaries = (sketches.histograms(df), sketches.quantile_sketches(df)) if summaries else None
+
+    return weekly, df, shard_summaries, {**attrition, **deviation_attrition}
+
+
+def _concat_shards(shards, by):
+
+    if len(shards) == 1:
+        return shards[0]
+
+    # Restore the order of the serial computation
+    df = pd.concat(shards)
+    df.sort_values(by=by, inplace=True)
+    df.reset_index(drop=True, inplace=True)
+
+    return df
+
+
+@profiling.instrument()
+def process_shards(n_jobs=1, backend='pandas', thresholds=None, lookup=None, summaries=False, vitals_file=None, tests_file=None):
+    """
+    Weekly aggregates and weekly deviations of the processed vital data.
+
+    All steps (selecting the weeks around the test, weekly means, baseline
+    and deviations) are independent across users. Users are therefore
+    hash-partitioned into n_jobs shards by their user id and each shard runs
+    the whole chain in a separate process. Each process reads the users of
+    its shard from the input files, so the vital data is neither loaded by
+    the parent process nor sent to the workers. The result is identical to
+    the serial computation.
+
+    Args:
+        n_jobs (int, optional): Number of shards and processes. Defaults to 1.
+        backend (str, optional): Compute weekly means and baselines with
+            'pandas' or 'numpy', see weekly_means(). Defaults to 'pandas'.
+        thresholds (tuple, optional): min_points_per_week and
+            min_weeks_for_baseline, see deviations_from_weekly(). Defaults to
+            None to only compute the weekly aggregates.
+        lookup (numpy.ndarray, optional): If given, add the cohort mask of
+            each user to the deviations, see add_cohort_mask(). Defaults to None.
+        summaries (bool, optional): Also summarize the deviations of each
+            shard with sketches.histograms() and sketches.quantile_sketches()
+            while they are computed and merge the summaries of all shards.
+            Requires thresholds and lookup. Defaults to False.
+        vitals_file (str, optional): Processed vital data. Defaults to VITALS_PROCESSED_FILE.
+        tests_file (str, optional): Test data. Defaults to TESTS_FILE.
+
+    Returns:
+        tuple: The weekly aggregates, the weekly deviations (None without
+        thresholds) and the histograms and quantile sketches (None without summaries).
+    """
+    if summaries and (thresholds is None or lookup is None):
+        raise ValueError('Summaries require thresholds and a cohort lookup')
+
+    args = (
+        range(n_jobs),
+        repeat(n_jobs),
+        repeat(backend),
+        repeat(thresholds),
+        repeat(lookup),
+        repeat(summaries),
+        repeat(vitals_file or VITALS_PROCESSED_FILE),
+        repeat(tests_file or TESTS_FILE)
+    )
+
+    if n_jobs == 1:
+        results = list(map(_process_shard, *args))
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            results = list(executor.map(_process_shard, *args))
+
+    weekly = _concat_shards([weekly for weekly, _, _, _ in results], ['userid', 'vitalid', 'weeks_since_test'])
+    df = None
+    if thresholds is not None:
+        df = _concat_shards([df for _, df, _, _ in results], ['userid', 'vitalid', 'weeks_since_test'])
+
+    # Counts of the shards add up. Summaries are merged even for a single
+    # shard so that their rows are in the same order for any n_jobs.
+    merged = None
+    if summaries:
+        merged = tuple(sketches.merge(*shard_summaries) for shard_summaries in zip(*[summary for _, _, summary, _ in results]))
+
+    # Shards hold disjoint sets of users, so user counts add up
+    for description in results[0][3]:
+        profiling.remaining(description, sum(attrition[description] for _, _, _, attrition in results))
+
+    return weekly, df, merged
+
+
+# Weekly aggregates and cohort lookup of a sweep in a worker process, see _init_sweep_worker()
+_sweep_inputs = {}
+
+
+def _init_sweep_worker(weekly, lookup):
+
+    _sweep_inputs['weekly'] = weekly
+    _sweep_inputs['lookup'] = lookup
+
+
+def _sweep_point(min_points_per_week, min_weeks_for_baseline, backend, output_dir, weekly=None, lookup=None):
+
+    if weekly is None:
+        weekly, lookup = _sweep_inputs['weekly'], _sweep_inputs['lookup']
+
+    df, attrition = _deviations_from_weekly(weekly, min_points_per_week, min_weeks_for_baseline, backend)
+    if lookup is not None:
+        df = add_cohort_mask(df, lookup)
+
+    output_file = Path(output_dir) / f'weekly_vital_deviations_per_user_{min_points_per_week}_{min_weeks_for_baseline}.feather'
+    df.to_feather(output_file)
+
+    return output_file, attrition
+
+
+@profiling.instrument()
+def sweep(weekly, min_points_per_week, min_weeks_for_baseline, output_dir, n_jobs=1, backend='pandas', cohort_lookup=None):
+    """
+    Compute weekly deviations for a grid of thresholds.
+
+    All grid points are derived from the same weekly aggregates, so the vital
+    data is only processed once. Grid points are computed in n_jobs
+    processes, each of which receives the weekly aggregates once. The
+    deviations of each grid point are written to
+    output_dir/weekly_vital_deviations_per_user_<min_points_per_week>_<min_weeks_for_baseline>.feather.
+
+    Args:
+        weekly (pandas.DataFrame): Weekly aggregates as returned by weekly_aggregates().
+        min_points_per_week (list of int): Values of min_points_per_week to test.
+        min_weeks_for_baseline (list of int): Values of min_weeks_for_baseline to test.
+        output_dir (str): Directory for the results.
+        n_jobs (int, optional): Number of processes. Defaults to 1.
+        backend (str, optional): Compute baselines with 'pandas' or 'numpy'. Defaults to 'pandas'.
+        cohort_lookup (numpy.ndarray, optional): If given, add the cohort mask
+            of each user to the results, see add_cohort_mask(). Defaults to None.
+
+    Returns:
+        dict: Maps each grid point (min_points_per_week, min_weeks_for_baseline) to its output file.
+    """
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    grid = list(product(min_points_per_week, min_weeks_for_baseline))
+    args = ([points for points, _ in grid], [weeks for _, weeks in grid], repeat(backend), repeat(output_dir))
+
+    if n_jobs == 1:
+        results = list(map(partial(_sweep_point, weekly=weekly, lookup=cohort_lookup), *args))
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_sweep_worker, initargs=(weekly, cohort_lookup)) as executor:
+            results = list(executor.map(_sweep_point, *args))
+
+    for (points, weeks), (_, attrition) in zip(grid, results):
+        for description, n_users in attrition.items():
+            profiling.remaining(f'min_points_per_week={points}, min_weeks_for_baseline={weeks}: {description}', n_users)
+
+    return {point: output_file for point, (output_file, _) in zip(grid, results)}
+
+
+@profiling.instrument()
 def user_cohorts(metadata):
+    """
+    Assign users to cohorts.
 
+    A user belongs to a cohort if any of their rows in metadata fulfills the
+    criteria of the cohort. Membership is returned both as one boolean column
+    per cohort and as a bitmask in the column cohort_mask, see cohort_bits().
+
+    Args:
+        metadata (pandas.DataFrame): Vaccinations merged with test results.
+
+    Returns:
+        pandas.DataFrame: Cohorts of each user.
+    """
     cohorts = pd.DataFrame(metadata.user_id, columns=['user_id'])
 
     invalid = metadata.jansen_received == True 
     full_or_booster = metadata.status.isin(['full', 'booster'])
 
-    print('Number of users that received jansen:', invalid.sum())
+    profiling.dropped(invalid.sum(), 'users that received jansen from the vaccinated cohort.')
 
     positive = metadata.test_result == 'positive'
     negative = metadata.test_result == 'negative'
@@ -76,35 +554,201 @@ def user_cohorts(metadata):
 
     total = vaccinated | unvaccinated | negative 
 
-    cohorts.loc[cohorts.user_id.isin(metadata[positive].user_id), 'positive'] = True
-    cohorts.loc[cohorts.user_id.isin(metadata[negative].user_id), 'negative'] = True
+    flags = [positive, negative, unvaccinated, vaccinated, vaccinated_delta, vaccinated_omicron, total]
+    row_mask = np.zeros(len(metadata), dtype=np.uint8)
+    for bit, flag in enumerate(flags):
+        row_mask |= flag.values.astype(np.uint8) << bit
 
-    cohorts.loc[cohorts.user_id.isin(metadata[unvaccinated].user_id), 'unvaccinated'] = True
-    cohorts.loc[cohorts.user_id.isin(metadata[vaccinated].user_id), 'vaccinated'] = True
+    # Combine the masks of all rows of each user
+    codes, uniques = pd.factorize(metadata.user_id)
+    user_mask = np.zeros(len(uniques), dtype=np.uint8)
+    np.bitwise_or.at(user_mask, codes, row_mask)
 
-    cohorts.loc[cohorts.user_id.isin(metadata[vaccinated_delta].user_id), 'vaccinated_delta'] = True
-    cohorts.loc[cohorts.user_id.isin(metadata[vaccinated_omicron].user_id), 'vaccinated_omicron'] = True
+    cohorts['cohort_mask'] = user_mask[codes]
+    for key in COHORT_KEYS:
+        cohorts.insert(len(cohorts.columns) - 1, key, in_cohort(cohorts.cohort_mask, key))
 
-    cohorts.loc[cohorts.user_id.isin(metadata[total].user_id), 'total'] = True
+    return schema.enforce(cohorts, schema.USER_COHORTS)
 
-    cohorts.fillna(False, inplace=True)
 
-    return cohorts
+def cohort_lookup(cohorts):
+    """
+    Dense table of cohort masks indexed by user id.
 
+    Args:
+        cohorts (pandas.DataFrame): User cohorts as returned by user_cohorts().
 
-def main():
+    Returns:
+        numpy.ndarray: Array of length max(user_id) + 1 whose element i is
+        the cohort mask of user i (0 for users without cohort).
+    """
+    lookup = np.zeros(cohorts.user_id.max() + 1 if len(cohorts) else 0, dtype=np.uint8)
+    lookup[cohorts.user_id.values] = cohorts.cohort_mask.values
 
-    vitals = pd.read_feather('data/02_processed/vitals_processed.feather')
-    tests = pd.read_feather('data/01_raw/tests.feather')
-    vaccs = pd.read_feather('data/01_raw/vaccinations.feather')
+    return lookup
 
-    df = weekly_deviations(vitaldata=vitals, testdata=tests, min_points_per_week=6, min_weeks_for_baseline=3)
-    df.to_feather('data/03_derived/weekly_vital_deviations_per_user.feather')
+
+@profiling.instrument()
+def add_cohort_mask(df, lookup):
+    """
+    Add the column cohort_mask with the cohort mask of each row's user.
+
+    Args:
+        df (pandas.DataFrame): Data with user ids in the column userid.
+        lookup (numpy.ndarray): Cohort masks by user id as returned by cohort_lookup().
+
+    Returns:
+        pandas.DataFrame: The data with the additional column.
+    """
+    userid = df.userid.values
+    known = userid < len(lookup)
+
+    mask = np.zeros(len(df), dtype=np.uint8)
+    mask[known] = lookup[userid[known]]
+    df['cohort_mask'] = mask
+
+    return df
+
+
+VITALS_PROCESSED_FILE = 'data/02_processed/vitals_processed.feather'
+TESTS_FILE = 'data/01_raw/tests.feather'
+WEEKLY_AGGREGATES_FILE = 'data/03_derived/weekly_aggregates.feather'
+BACKEND_METADATA_KEY = 'long_covid.backend'
+SWEEP_DIR = 'data/03_derived/sweep'
+COHORT_MASKS_FILE = 'data/03_derived/cohort_masks.npy'
+HISTOGRAMS_FILE = 'data/03_derived/histograms.feather'
+QUANTILE_SKETCHES_FILE = 'data/03_derived/quantile_sketches.feather'
+
+
+@profiling.instrument()
+def load_inputs(shard=0, n_shards=1, vitals_file=VITALS_PROCESSED_FILE, tests_file=TESTS_FILE, verbose=True):
+    """
+    Processed vital data and test data of the users in one shard, see
+    dataset.read_shard(). Defaults to all users.
+    """
+    vitals = dataset.read_shard(vitals_file, shard, n_shards)
+    tests = dataset.read_shard(tests_file, shard, n_shards, user_column='user_id')
+
+    vitals = schema.enforce(vitals, schema.VITALS_PROCESSED, label='processed vitals' if verbose else None)
+    tests = schema.enforce(tests, schema.TESTS, label='tests' if verbose else None)
+
+    return vitals, tests
+
+
+def write_weekly_aggregates(weekly, backend, output_file=WEEKLY_AGGREGATES_FILE):
+    """
+    Write weekly aggregates to a feather file and record the backend that
+    computed them in the metadata of the file.
+    """
+    table = pa.Table.from_pandas(weekly, preserve_index=False)
+    table = table.replace_schema_metadata({**table.schema.metadata, BACKEND_METADATA_KEY: backend})
+    feather.write_feather(table, str(output_file))
+
+
+def _weekly_backend(input_file):
+    """
+    Backend recorded by write_weekly_aggregates(). None for older files.
+    """
+    with pa.memory_map(str(input_file)) as source:
+        metadata = pa.ipc.open_file(source).schema.metadata or {}
+
+    backend = metadata.get(BACKEND_METADATA_KEY.encode())
+
+    return backend.decode() if backend is not None else None
+
+
+def cached_weekly_aggregates(n_jobs=1, backend='pandas'):
+    """
+    Weekly aggregates from WEEKLY_AGGREGATES_FILE if it is newer than the
+    processed vital data and the test data and was computed with the same
+    backend. Otherwise compute and store them.
+    """
+    inputs = [VITALS_PROCESSED_FILE, TESTS_FILE]
+    cache = Path(WEEKLY_AGGREGATES_FILE)
+
+    if (
+        cache.exists()
+        and all(cache.stat().st_mtime > Path(f).stat().st_mtime for f in inputs)
+        and _weekly_backend(cache) == backend
+    ):
+        print('Reading weekly aggregates from', WEEKLY_AGGREGATES_FILE)
+        return pd.read_feather(cache)
+
+    weekly, _, _ = process_shards(n_jobs=n_jobs, backend=backend)
+    write_weekly_aggregates(weekly, backend, cache)
+
+    return weekly
+
+
+@profiling.instrument('compute')
+def main(partitioned=False, n_jobs=1, backend='pandas'):
+
+    tests = schema.enforce(pd.read_feather(TESTS_FILE), schema.TESTS, label='tests')
+    vaccs = schema.enforce(pd.read_feather('data/01_raw/vaccinations.feather'), schema.VACCINATIONS, label='vaccinations')
 
     metadata = pd.merge(vaccs, tests, on='user_id')
-    df = user_cohorts(metadata)
-    df.to_feather('data/03_derived/user_cohorts.feather')
+    cohorts = user_cohorts(metadata)
+    cohorts.to_feather('data/03_derived/user_cohorts.feather')
+    lookup = cohort_lookup(cohorts)
+    np.save(COHORT_MASKS_FILE, lookup)
+
+    weekly, df, (histograms, quantile_sketches) = process_shards(
+        n_jobs=n_jobs, backend=backend, thresholds=(6, 3), lookup=lookup, summaries=True
+    )
+    write_weekly_aggregates(weekly, backend)
+
+    print(f'Memory usage of weekly deviations: {schema.memory_usage(df):.1f} MB')
+    df.to_feather('data/03_derived/weekly_vital_deviations_per_user.feather')
+    if partitioned:
+        write_partitioned(df, 'data/03_derived/weekly_vital_deviations_per_user')
+
+    histograms.to_feather(HISTOGRAMS_FILE)
+    quantile_sketches.to_feather(QUANTILE_SKETCHES_FILE)
+
+
+@profiling.instrument('compute_sweep')
+def main_sweep(min_points_per_week, min_weeks_for_baseline, n_jobs=1, backend='pandas'):
+
+    weekly = cached_weekly_aggregates(n_jobs=n_jobs, backend=backend)
+    lookup = np.load(COHORT_MASKS_FILE) if Path(COHORT_MASKS_FILE).exists() else None
+    sweep(weekly, min_points_per_week, min_weeks_for_baseline, SWEEP_DIR, n_jobs=n_jobs, backend=backend, cohort_lookup=lookup)
     
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description='Compute weekly deviations in vital data and user cohorts.')
+    parser.add_argument('--partitioned', action='store_true', help='also write weekly deviations as a partitioned Parquet dataset')
+    parser.add_argument('--n-jobs', type=int, default=1, help='number of processes for computing weekly deviations')
+    parser.add_argument('--backend', choices=['pandas', 'numpy'], default='pandas', help='backend for weekly and baseline aggregates')
+    parser.add_argument('--sweep', action='store_true', help=f'only compute weekly deviations for a grid of thresholds and write them to {SWEEP_DIR}')
+    parser.add_argument('--min-points-per-week', type=int, nargs='+', default=[6], help='values of min_points_per_week for --sweep')
+    parser.add_argument('--min-weeks-for-baseline', type=int, nargs='+', default=[3], help='values of min_weeks_for_baseline for --sweep')
+    parser.add_argument('--trace-memory', action='store_true', help='record the peak memory of each stage with tracemalloc (slow)')
+    cache.add_arguments(parser)
+    args = parser.parse_args()
+
+    if args.trace_memory:
+        profiling.trace_memory()
+
+    if args.sweep:
+        main_sweep(args.min_points_per_week, args.min_weeks_for_baseline, n_jobs=args.n_jobs, backend=args.backend)
+    else:
+        cache.run_cached(
+            'compute',
+            main,
+            kwargs={'partitioned': args.partitioned, 'n_jobs': args.n_jobs, 'backend': args.backend},
+            inputs=[VITALS_PROCESSED_FILE, TESTS_FILE, 'data/01_raw/vaccinations.feather'],
+            outputs=[
+                'data/03_derived/weekly_vital_deviations_per_user.feather',
+                'data/03_derived/user_cohorts.feather',
+                COHORT_MASKS_FILE,
+                HISTOGRAMS_FILE,
+                QUANTILE_SKETCHES_FILE,
+                WEEKLY_AGGREGATES_FILE
+            ] + (['data/03_derived/weekly_vital_deviations_per_user'] if args.partitioned else []),
+            sources=[__file__, schema.__file__, dataset.__file__, sketches.__file__],
+            unkeyed=['n_jobs'],
+            force=args.force,
+            budget=args.cache_budget * 2**30
+        )
+
+    profiling.write_report('compute_sweep' if args.sweep else 'compute')
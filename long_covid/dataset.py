@@ -0,0 +1,135 @@
+"""
+Store and read vital data as Hive-partitioned Parquet datasets.
+
+Datasets are partitioned by vitalid and by a bucket of the user id so that
+reads for single vitals or single users only touch the files they need.
+read_shard() reads the users of one hash shard from a feather file.
+"""
+from pathlib import Path
+import json
+import shutil
+import numpy as np
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+
+N_BUCKETS = 32
+LAYOUT_FILE = '_layout.json'
+
+
+def write_partitioned(df, path, n_buckets=N_BUCKETS, user_column='userid', append=False):
+    """
+    Write a data frame as a Parquet dataset partitioned by vitalid and user
+    bucket (user id modulo n_buckets).
+
+    Existing data at path is replaced unless append is True.
+
+    Args:
+        df (pandas.DataFrame): The data. Must contain the columns 'vitalid' and user_column.
+        path (str): Directory of the dataset.
+        n_buckets (int, optional): Number of user buckets. Defaults to N_BUCKETS.
+        user_column (str, optional): Name of the column with user ids. Defaults to 'userid'.
+        append (bool, optional): Add the data to an existing dataset with the
+            same layout, e.g., when writing it in chunks. Defaults to False.
+    """
+    table = pa.Table.from_pandas(df.assign(user_bucket=df[user_column] % n_buckets), preserve_index=False)
+
+    if not append:
+        shutil.rmtree(path, ignore_errors=True)
+    pq.write_to_dataset(table, path, partition_cols=['vitalid', 'user_bucket'])
+
+    # Files starting with '_' are ignored when reading the dataset
+    layout = {
+        'n_buckets': n_buckets,
+        'user_column': user_column,
+        'columns': list(df.columns),
+        'vitalid_type': str(table.schema.field('vitalid').type)
+    }
+    with open(Path(path) / LAYOUT_FILE, 'w') as outfile:
+        json.dump(layout, outfile, indent=4)
+
+
+def read_partitioned(path, columns=None, user_ids=None, vitalids=None, filter=None):
+    """
+    Read (parts of) a dataset written with write_partitioned().
+
+    Selecting vitalids or user_ids prunes partitions so that only the
+    corresponding files are read. Further predicates and the column
+    selection are pushed down to the Parquet reader.
+
+    Args:
+        path (str): Directory of the dataset.
+        columns (list of str, optional): Columns to read. Defaults to all columns.
+        user_ids (int or list/array of int, optional): Only read data of these users. Defaults to None.
+        vitalids (int or list/array of int, optional): Only read data of these vitals. Defaults to None.
+        filter (pyarrow.dataset.Expression, optional): Additional predicate,
+            e.g., ds.field('weeks_since_test') >= 0. Defaults to None.
+
+    Returns:
+        pandas.DataFrame: The selected data.
+    """
+    with open(Path(path) / LAYOUT_FILE) as infile:
+        layout = json.load(infile)
+
+    partitioning = ds.partitioning(
+        pa.schema([('vitalid', pa.type_for_alias(layout['vitalid_type'])), ('user_bucket', pa.int32())]),
+        flavor='hive'
+    )
+    dataset = ds.dataset(path, format='parquet', partitioning=partitioning)
+
+    expression = None
+    if vitalids is not None:
+        expression = _and(expression, ds.field('vitalid').isin(np.atleast_1d(vitalids)))
+    if user_ids is not None:
+        user_ids = np.atleast_1d(user_ids)
+        buckets = np.unique(user_ids % layout['n_buckets'])
+        expression = _and(expression, ds.field('user_bucket').isin(buckets))
+        expression = _and(expression, ds.field(layout['user_column']).isin(user_ids))
+    if filter is not None:
+        expression = _and(expression, filter)
+
+    if columns is None:
+        columns = layout['columns']
+
+    return dataset.to_table(columns=columns, filter=expression).to_pandas()
+
+
+def read_shard(path, shard, n_shards, user_column='userid', columns=None):
+    """
+    Read the rows of the users in one shard (user id modulo n_shards) from a
+    feather file.
+
+    The file is memory-mapped and filtered record batch by record batch, so
+    only the rows of the shard are held in memory at the same time.
+
+    Args:
+        path (str): The feather file.
+        shard (int): The shard, between 0 and n_shards - 1.
+        n_shards (int): Number of shards. With 1 shard all rows are read.
+        user_column (str, optional): Name of the column with user ids. Defaults to 'userid'.
+        columns (list of str, optional): Columns to read. Defaults to all columns.
+
+    Returns:
+        pandas.DataFrame: The rows of the shard in the order of the file.
+    """
+    with pa.memory_map(str(path)) as source:
+        reader = pa.ipc.open_file(source)
+
+        batches = []
+        for i in range(reader.num_record_batches):
+            batch = reader.get_batch(i)
+            if n_shards > 1:
+                users = batch.column(user_column).to_numpy()
+                batch = batch.filter(pa.array(users % n_shards == shard))
+            batches.append(batch.select(columns) if columns is not None else batch)
+
+        schema = reader.schema if columns is None else pa.schema([reader.schema.field(name) for name in columns], reader.schema.metadata)
+        df = pa.Table.from_batches(batches, schema=schema).to_pandas()
+
+    return df
+
+
+def _and(expression, other):
+
+    return other if expression is None else expression & other
@@ -0,0 +1,170 @@
+"""
+Read-only access to the derived data for the notebooks.
+
+The weekly deviations are joined with the user cohorts once and stored as an
+uncompressed Arrow IPC file. All notebooks memory-map this file instead of
+reading and merging the feather files on their own, so the data is parsed
+once and the pages are shared between kernels by the operating system.
+
+Paths are relative to the working directory like in the rest of the
+pipeline. The notebooks run in notebooks/ and therefore pass derived_dir:
+
+    from long_covid import derived
+    DATA = derived.cohort_data(derived_dir='../data/03_derived')
+"""
+from functools import lru_cache
+from pathlib import Path
+import numpy as np
+import pyarrow as pa
+import pyarrow.feather as feather
+
+
+DERIVED_DIR = 'data/03_derived'
+WEEKLY_DEVIATIONS_FILE = 'weekly_vital_deviations_per_user.feather'
+USER_COHORTS_FILE = 'user_cohorts.feather'
+COHORT_DATA_FILE = 'weekly_vital_deviations_with_cohorts.arrow'
+
+
+def read_table(path):
+    """
+    Open a feather/Arrow IPC file as a memory-mapped Arrow table.
+
+    Reading is zero-copy if the file is uncompressed. The buffers of the
+    table are read-only.
+
+    Args:
+        path (str): The file.
+
+    Returns:
+        pyarrow.Table: The table.
+    """
+    return feather.read_table(str(path), memory_map=True)
+
+
+def join_cohorts(deviations, cohorts):
+    """
+    Add the cohort flags of each user to the weekly deviations.
+
+    Same as pd.merge(deviations, cohorts, left_on='userid',
+    right_on='user_id').drop(columns='user_id'), but since there is one row
+    per user in cohorts, the flags are gathered by position instead of
+    merging.
+
+    Args:
+        deviations (pyarrow.Table): The weekly deviations.
+        cohorts (pyarrow.Table): The user cohorts.
+
+    Returns:
+        pyarrow.Table: Weekly deviations of users with a cohort and their cohort flags.
+    """
+    deviations = _drop_index(deviations)
+    cohorts = _drop_index(cohorts)
+
+    user_ids = cohorts.column('user_id').to_numpy()
+    order = np.argsort(user_ids)
+    sorted_ids = user_ids[order]
+
+    userid = deviations.column('userid').to_numpy()
+    position = np.minimum(np.searchsorted(sorted_ids, userid), len(sorted_ids) - 1)
+    found = sorted_ids[position] == userid if len(sorted_ids) else np.zeros(len(userid), dtype=bool)
+
+    # Inner join: keep the order of the deviations and drop users without a cohort
+    df = deviations.filter(pa.array(found))
+    duplicates = [name for name in cohorts.column_names if name == 'user_id' or name in deviations.column_names]
+    flags = cohorts.drop(duplicates).take(pa.array(order[position[found]]))
+
+    for name, column in zip(flags.column_names, flags.columns):
+        df = df.append_column(name, column)
+
+    # The pandas metadata of deviations does not describe the joined columns
+    return df.replace_schema_metadata(None)
+
+
+def _drop_index(table):
+
+    # pandas stores non-range indexes as extra columns
+    return table.select([name for name in table.column_names if not name.startswith('__index_level_')])
+
+
+def write_cohort_data(derived_dir=DERIVED_DIR):
+    """
+    Join the weekly deviations with the user cohorts and write the result as
+    an uncompressed Arrow IPC file that can be memory-mapped without copies.
+
+    The file is written to a temporary file first and then moved so that
+    kernels that read it at the same time never see a partial file.
+
+    Args:
+        derived_dir (str, optional): Directory of the derived data. Defaults to DERIVED_DIR.
+    """
+    derived_dir = Path(derived_dir)
+    output_file = derived_dir / COHORT_DATA_FILE
+
+    df = join_cohorts(read_table(derived_dir / WEEKLY_DEVIATIONS_FILE), read_table(derived_dir / USER_COHORTS_FILE))
+
+    temporary = Path(f'{output_file}.tmp')
+    feather.write_feather(df, str(temporary), compression='uncompressed')
+    temporary.replace(output_file)
+
+
+@lru_cache(maxsize=None)
+def cohort_table(derived_dir=DERIVED_DIR):
+    """
+    The weekly deviations joined with the user cohorts as a memory-mapped
+    Arrow table.
+
+    The joined file is (re)written if it is missing or older than the weekly
+    deviations or the user cohorts. The table is opened once per process.
+
+    Args:
+        derived_dir (str, optional): Directory of the derived data. Defaults to DERIVED_DIR.
+
+    Returns:
+        pyarrow.Table: Read-only table of the joined data.
+    """
+    derived_dir = Path(derived_dir)
+    output_file = derived_dir / COHORT_DATA_FILE
+
+    inputs = [derived_dir / WEEKLY_DEVIATIONS_FILE, derived_dir / USER_COHORTS_FILE]
+    if not output_file.exists() or any(output_file.stat().st_mtime < f.stat().st_mtime for f in inputs):
+        write_cohort_data(derived_dir)
+
+    return read_table(output_file)
+
+
+def cohort_data(columns=None, derived_dir=DERIVED_DIR):
+    """
+    The weekly deviations joined with the user cohorts as a pandas data
+    frame.
+
+    Numeric columns are views on the memory-mapped file and cannot be
+    modified in place. Use DataFrame.copy() to get a writeable copy.
+
+    Args:
+        columns (list of str, optional): Columns to include. Defaults to all columns.
+        derived_dir (str, optional): Directory of the derived data. Defaults to DERIVED_DIR.
+
+    Returns:
+        pandas.DataFrame: The joined data.
+    """
+    table = cohort_table(derived_dir)
+    if columns is not None:
+        table = table.select(columns)
+
+    return table.to_pandas(split_blocks=True)
+
+
+@lru_cache(maxsize=None)
+def weekly_deviations(derived_dir=DERIVED_DIR):
+    """
+    The weekly deviations as a memory-mapped Arrow table.
+    """
+    return read_table(Path(derived_dir) / WEEKLY_DEVIATIONS_FILE)
+
+
+@lru_cache(maxsize=None)
+def user_cohorts(derived_dir=DERIVED_DIR):
+    """
+    The user cohorts as a memory-mapped Arrow table.
+    """
+    return read_table(Path(derived_dir) / USER_COHORTS_FILE)
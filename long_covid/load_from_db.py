@@ -1,77 +1,331 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from dotenv import load_dotenv
+from functools import lru_cache
+import atexit
+import io
 import os
+import threading
+import time
 import psycopg2
+import psycopg2.pool
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.csv
+from long_covid import profiling, schema
+from long_covid.query_cache import QueryCache
 
 
-def connector():
-    """
-    Establish connection to the ROCS data base.
+VITALS_COLUMNS = ['userid', 'date', 'vitalid', 'value', 'deviceid']
+VITALS_ARROW_TYPES = {
+    'userid': pa.int32(), 'date': pa.date32(), 'vitalid': pa.int8(), 'value': pa.float32(), 'deviceid': pa.int16()
+}
 
-    Requires that all environment variables are set in .env in the root of this repository.
+POOL_SIZE = 8
+
+_pool = None
+_pool_size = POOL_SIZE
+_pool_slots = threading.BoundedSemaphore(POOL_SIZE)
+_pool_lock = threading.Lock()
+
+_query_cache = None
+
+
+@lru_cache(maxsize=None)
+def _connection_parameters():
+    """
+    Read the credentials of the ROCS data base from .env once.
 
     Returns:
-        connection: The data base connector.
+        dict: Keyword arguments for psycopg2.connect().
     """
     load_dotenv()
-    
-    conn = psycopg2.connect(**{
+
+    return {
         "database": os.getenv("DBNAME"),
         "user": os.getenv("DBUSER"),
         "port": os.getenv("PORT"),
         "host": os.getenv("HOST"),
         "password": os.getenv("PASSWORD")
-        }
-    )
+    }
+
+
+def connector():
+    """
+    Establish connection to the ROCS data base.
+
+    Requires that all environment variables are set in .env in the root of this repository.
+
+    Returns:
+        connection: The data base connector.
+    """
+    conn = psycopg2.connect(**_connection_parameters())
     
     return conn
 
 
-def run_query(query):
+class TimedConnectionPool(psycopg2.pool.ThreadedConnectionPool):
+    """
+    Thread-safe connection pool that records the time it takes to establish
+    each new connection (TCP/TLS handshake and authentication).
+
+    Connections are opened lazily, but, unlike in psycopg2's pools, every
+    returned connection is kept open for reuse up to maxconn.
+    """
+
+    def __init__(self, maxconn, *args, **kwargs):
+        self.setup_times = []
+        super().__init__(0, maxconn, *args, **kwargs)
+
+        # psycopg2 closes returned connections once more than minconn are
+        # idle. Raising minconn only after initialization keeps them all open
+        # without connecting eagerly.
+        self.minconn = maxconn
+
+    def _connect(self, key=None):
+        start = time.perf_counter()
+        conn = super()._connect(key)
+        self.setup_times.append(time.perf_counter() - start)
+
+        return conn
+
+
+def configure_pool(size=POOL_SIZE):
+    """
+    Set the maximum number of connections that are kept open to the data base.
+
+    Closes all connections of an existing pool. The new pool is created the
+    next time a connection is requested.
+
+    Args:
+        size (int, optional): Maximum number of concurrent connections. Defaults to POOL_SIZE.
+    """
+    global _pool_size, _pool_slots
+
+    close_pool()
+    with _pool_lock:
+        _pool_size = size
+        _pool_slots = threading.BoundedSemaphore(size)
+
+
+def close_pool():
+    """
+    Close all connections in the connection pool.
+    """
+    global _pool
+
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+
+
+def connection_setup_times():
+    """
+    Time it took to establish each connection of the current pool.
+
+    Returns:
+        list of float: Setup time per connection in seconds.
+    """
+    if _pool is None:
+        return []
+
+    return list(_pool.setup_times)
+
+
+def _get_pool():
+
+    global _pool
+
+    with _pool_lock:
+        if _pool is None:
+            _pool = TimedConnectionPool(_pool_size, **_connection_parameters())
+
+    return _pool
+
+
+@contextmanager
+def connection():
+    """
+    Borrow a connection from the shared connection pool.
+
+    Connections are established lazily and reused across queries. If all
+    connections are in use, the calling thread blocks until one is returned.
+
+    Yields:
+        connection: The data base connector.
+    """
+    slots = _pool_slots
+    with slots:
+        pool = _get_pool()
+        conn = pool.getconn()
+        try:
+            yield conn
+        finally:
+            pool.putconn(conn)
+
+
+atexit.register(close_pool)
+
+
+def enable_query_cache(**kwargs):
+    """
+    Cache the results of run_query() on disk.
+
+    Repeated queries with the same (normalized) SQL and parameters are then
+    read from the cache instead of the data base.
+
+    Args:
+        **kwargs: Passed on to query_cache.QueryCache, e.g., path, ttl or max_bytes.
+
+    Returns:
+        query_cache.QueryCache: The cache.
+    """
+    global _query_cache
+
+    _query_cache = QueryCache(**kwargs)
+
+    return _query_cache
+
+
+def disable_query_cache():
+    """
+    Send all queries of run_query() to the data base again.
+    """
+    global _query_cache
+
+    _query_cache = None
+
+
+def query_cache_stats():
+    """
+    Hits and misses of the query cache.
+
+    Returns:
+        dict: See query_cache.QueryCache.stats(). None if the cache is disabled.
+    """
+    return None if _query_cache is None else _query_cache.stats()
+
+
+def run_query(query, params=None):
     """
     Run an SQL query against the ROCS postgres database.
 
+    If the query cache is enabled (see enable_query_cache()), cached results
+    are returned without querying the data base.
+
     Args:
         query (str): the SQL query to execute.
+        params (dict, optional): Parameters of the query, referenced as
+            %(name)s in the query. Defaults to None.
 
     Returns:
         pandas.DataFrame: The query results.
     """
-    conn = connector()
-    df = pd.read_sql_query(query, conn)
-    conn.close()
+    cache = _query_cache
+    if cache is not None:
+        df = cache.get(query, params)
+        if df is not None:
+            return df
+
+    with connection() as conn:
+        df = pd.read_sql_query(query, conn, params=params)
+
+    if cache is not None:
+        cache.put(query, params, df)
 
     return df
 
 
-def tuple_of_user_ids(user_ids):
+def run_concurrently(tasks, max_workers=None):
+    """
+    Run independent data base queries at the same time and report the wall
+    time of each.
+
+    Tasks run in separate threads and thus share the connection pool. The
+    total run time is therefore roughly that of the longest task, as long as
+    the pool holds enough connections.
+
+    Args:
+        tasks (dict): Maps a descriptive name to a callable without arguments.
+        max_workers (int, optional): Maximum number of concurrently running
+            tasks. Defaults to one thread per task.
+
+    Returns:
+        dict: Maps each name to the return value of its task.
+    """
+    def timed(name, task):
+        start = time.perf_counter()
+        result = task()
+        print(f'Finished {name} in {time.perf_counter() - start:.1f} seconds')
+        return result
+
+    with ThreadPoolExecutor(max_workers=max_workers or len(tasks)) as executor:
+        futures = {name: executor.submit(timed, name, task) for name, task in tasks.items()}
+        results = {name: future.result() for name, future in futures.items()}
+
+    return results
+
+
+def copy_query(query, column_types=None, params=None):
     """
-    Converts a given user id or list of user id's to a format that can be
-    inserted into IN statements of an SQL query.
+    Run an SQL query through COPY ... TO STDOUT and parse the result into an
+    Arrow table.
 
-    Ensures that the IN-condition for SQL queries either takes the form
-    '(userid)' in the case of a single requested user id or '(userid1, userid2,
-    ..., useridN)' in the case of multiple requested user ids.
+    The result is streamed as CSV and parsed column-wise by pyarrow, which
+    avoids creating one Python object per value as pandas.read_sql_query()
+    does. This is considerably faster for large results.
 
     Args:
-        user_ids (int, list, or array): User ids that are inserted into the SQL
+        query (str): the SQL query to execute. Must be a single SELECT statement.
+        column_types (dict, optional): Maps column names to pyarrow data types.
+            Columns that are not listed are type-inferred. Defaults to None.
+        params (dict, optional): Parameters of the query, referenced as
+            %(name)s in the query. Defaults to None.
+
+    Returns:
+        pyarrow.Table: The query results.
+    """
+    buffer = io.BytesIO()
+
+    with connection() as conn:
+        with conn.cursor() as cursor:
+            # COPY does not accept bind parameters, so they are quoted by psycopg2
+            if params is not None:
+                query = cursor.mogrify(query, params).decode()
+            cursor.copy_expert(f"COPY ({query}) TO STDOUT WITH (FORMAT CSV, HEADER)", buffer)
+
+    buffer.seek(0)
+    convert_options = pyarrow.csv.ConvertOptions(column_types=column_types)
+
+    return pyarrow.csv.read_csv(buffer, convert_options=convert_options)
+
+
+def user_id_array(user_ids):
+    """
+    Converts a given user id or list of user ids to a Postgres array literal
+    that is bound as a single query parameter.
+
+    Queries compare against the parameter with 'user_id = ANY(%(user_ids)s::integer[])'.
+    Unlike an IN-list with one constant per user id the query text does not
+    grow with the number of user ids, and the server parses the array once
+    instead of planning one expression per id.
+
+    Args:
+        user_ids (int, list, or array): User ids that are bound to the SQL
         queries.
 
     Returns:
-        tuple or string: Tuple containing all user ids.
+        str: The user ids in the form '{userid1,userid2,...,useridN}'.
     """
-    if isinstance(user_ids, int) or isinstance(user_ids, np.int64):
-        formatter = f'({user_ids})'
-    elif len(user_ids) == 1:
-        formatter = f'({user_ids[0]})'
-    else:
-        formatter = tuple(user_ids)
-    
-    return formatter
+    user_ids = np.atleast_1d(user_ids).astype(np.int64)
+
+    return '{' + ','.join(map(str, user_ids.tolist())) + '}'
 
 
-def get_vitals(user_ids, max_date="2022-04-03"):
+@profiling.instrument()
+def get_vitals(user_ids, max_date="2022-04-03", method='query', min_date=None):
     """
     Get vital data from the data base. 
 
@@ -80,31 +334,196 @@ def get_vitals(user_ids, max_date="2022-04-03"):
     Args:
         user_ids (int or list/array of int): User ids for which to retrieve the vital data.
         max_date (str, optional): The maximum allowed data of vital data. Defaults to "2022-04-03".
+        method (str, optional): Either 'query' to load the data through
+            pandas.read_sql_query() or 'copy' to bulk export it with COPY and
+            parse it with the fixed column types in VITALS_ARROW_TYPES.
+            Defaults to 'query'.
+        min_date (str, optional): If given, only load vital data recorded
+            after (and excluding) this date. Defaults to None.
 
     Returns:
         pandas.DataFrame: The vital data.
     """    
-    user_ids = tuple_of_user_ids(user_ids)
+    query, params = _vitals_query(user_ids, max_date=max_date, min_date=min_date)
+
+    if method == 'query':
+        vitals = run_query(query, params)
+        vitals.date = pd.to_datetime(vitals.date)    
+        vitals = schema.enforce(vitals, schema.VITALS)
+    elif method == 'copy':
+        vitals = copy_query(query, column_types=VITALS_ARROW_TYPES, params=params).to_pandas(date_as_object=False)
+    else:
+        print("'method' must be either 'query' or 'copy'")
+        return None
+
+    return vitals
+
+
+def _vitals_query(user_ids, max_date, min_date=None, paramstyle='pyformat'):
+    """
+    Build the SQL query that selects sleep duration, resting heart rate and
+    step count for a set of users.
+
+    User ids and dates are bound as parameters, so that the query text is the
+    same for all sets of users.
+
+    Args:
+        user_ids (int or list/array of int): User ids for which to retrieve the vital data.
+        max_date (str): The maximum allowed data of vital data.
+        min_date (str or list/array of str, optional): Exclusive lower bound
+            of the date of vital data. Either one date for all users or one
+            date per user in user_ids. Defaults to None.
+        paramstyle (str, optional): 'pyformat' for psycopg2, which binds all
+            user ids (and dates per user) as Postgres arrays, or 'named' for
+            other DB-API drivers such as sqlite3, which bind one :user_id_<i>
+            (and :min_date_<i>) parameter per user. Defaults to 'pyformat'.
+
+    Returns:
+        tuple: The SQL query and the dict of its parameters.
+    """
+    user_ids = np.atleast_1d(user_ids).astype(np.int64)
+    per_user = min_date is not None and not isinstance(min_date, str)
+    if per_user:
+        min_date = [str(date) for date in np.atleast_1d(min_date)]
+        if len(min_date) != len(user_ids):
+            raise ValueError('min_date must contain one date per user')
+
+    source = 'datenspende.vitaldata'
+    params = {}
+
+    if paramstyle == 'pyformat':
+        placeholder = '%({})s'
+        params['user_ids'] = user_id_array(user_ids)
+        if per_user:
+            # Pair each user with their own lower bound of the date
+            source += """
+    JOIN
+        unnest(%(user_ids)s::integer[], %(min_dates)s::date[]) AS marks(user_id, min_date)
+    ON
+        vitaldata.user_id = marks.user_id"""
+            users = 'vitaldata.date > marks.min_date'
+            params['min_dates'] = '{' + ','.join(min_date) + '}'
+        else:
+            users = 'vitaldata.user_id = ANY(%(user_ids)s::integer[])'
+    elif paramstyle == 'named':
+        placeholder = ':{}'
+        params.update({f'user_id_{i}': user_id for i, user_id in enumerate(user_ids.tolist())})
+        if per_user:
+            users = ' OR '.join(f'(vitaldata.user_id = :user_id_{i} AND vitaldata.date > :min_date_{i})' for i in range(len(user_ids)))
+            users = f'({users})'
+            params.update({f'min_date_{i}': date for i, date in enumerate(min_date)})
+        else:
+            users = f"vitaldata.user_id IN ({', '.join(f':user_id_{i}' for i in range(len(user_ids)))})"
+    else:
+        raise ValueError("'paramstyle' must be either 'pyformat' or 'named'")
 
     query = f"""
     SELECT 
-        user_id AS userid, date, type AS vitalid, value, source AS deviceid
+        vitaldata.user_id AS userid, vitaldata.date, vitaldata.type AS vitalid, vitaldata.value, vitaldata.source AS deviceid
     FROM 
-        datenspende.vitaldata
+        {source}
     WHERE 
-        vitaldata.user_id IN {user_ids}
+        {users}
     AND
         vitaldata.type IN (9, 65, 43)
     AND
-        vitaldata.date <= '{max_date}'
+        vitaldata.date <= {placeholder.format('max_date')}
+    """
+    params['max_date'] = max_date
+
+    if min_date is not None and not per_user:
+        query += f"""AND
+        vitaldata.date > {placeholder.format('min_date')}
     """
+        params['min_date'] = min_date
+
+    return query, params
+
+
+def _typed_vitals(rows):
+    """
+    Convert raw rows of vital data into a DataFrame with fixed column types.
+
+    Types follow schema.VITALS. Fixing the types ensures that all batches returned by iter_vitals() share
+    the same schema, irrespective of the number of rows or missing values in
+    any single batch.
 
-    vitals = run_query(query)
-    vitals.date = pd.to_datetime(vitals.date)    
+    Args:
+        rows (list of tuples): Rows in the order given by VITALS_COLUMNS.
+
+    Returns:
+        pandas.DataFrame: The vital data.
+    """
+    vitals = pd.DataFrame.from_records(rows, columns=VITALS_COLUMNS)
+    vitals = schema.enforce(vitals, schema.VITALS)
+    vitals.date = pd.to_datetime(vitals.date)
 
     return vitals
 
 
+def iter_vitals(user_ids, max_date="2022-04-03", batch_size=10000, chunk_size=500000, conn=None, min_date=None):
+    """
+    Stream vital data from the data base in chunks of bounded size.
+
+    Same as get_vitals() but user ids are queried in batches of batch_size and
+    the results of each batch are read through a named (server-side) cursor in
+    chunks of at most chunk_size rows. Peak memory is thus bounded by
+    chunk_size instead of the size of the whole cohort.
+
+    Args:
+        user_ids (int or list/array of int): User ids for which to retrieve the vital data.
+        max_date (str, optional): The maximum allowed data of vital data. Defaults to "2022-04-03".
+        batch_size (int, optional): Number of user ids per query. Defaults to 10000.
+        chunk_size (int, optional): Maximum number of rows per yielded chunk. Defaults to 500000.
+        conn (connection, optional): An open DB-API connection. If the connection
+            is not a psycopg2 connection (e.g., an sqlite3 stand-in for testing)
+            a regular client-side cursor is used and parameters are bound in
+            the 'named' paramstyle, see _vitals_query(). Defaults to a connection
+            borrowed from the shared connection pool.
+        min_date (str or list/array of str, optional): If given, only load
+            vital data recorded after (and excluding) this date. Either one
+            date for all users or one date per user in user_ids. Defaults to None.
+
+    Yields:
+        pandas.DataFrame: Chunks of vital data with the columns and types given
+        by VITALS_COLUMNS and schema.VITALS.
+    """
+    if conn is None:
+        with connection() as conn:
+            yield from iter_vitals(user_ids, max_date, batch_size, chunk_size, conn=conn, min_date=min_date)
+        return
+
+    user_ids = np.atleast_1d(user_ids)
+
+    is_psycopg2 = isinstance(conn, psycopg2.extensions.connection)
+    per_user = min_date is not None and not isinstance(min_date, str)
+    if per_user:
+        min_date = np.atleast_1d(min_date)
+
+    for start in range(0, len(user_ids), batch_size):
+        query, params = _vitals_query(
+            user_ids[start:start + batch_size], max_date=max_date,
+            min_date=min_date[start:start + batch_size] if per_user else min_date,
+            paramstyle='pyformat' if is_psycopg2 else 'named'
+        )
+
+        if is_psycopg2:
+            cursor = conn.cursor(name='iter_vitals')
+            cursor.itersize = chunk_size
+        else:
+            cursor = conn.cursor()
+
+        try:
+            cursor.execute(query, params)
+            rows = cursor.fetchmany(chunk_size)
+            while rows:
+                yield _typed_vitals(rows)
+                rows = cursor.fetchmany(chunk_size)
+        finally:
+            cursor.close()
+
+
+@profiling.instrument()
 def get_user_data(user_ids):
     """
     Get user data from the data base.
@@ -115,27 +534,42 @@ def get_user_data(user_ids):
     Returns:
         _pandas.DataFrame: The user data data.
     """    
-    user_ids = tuple_of_user_ids(user_ids)
-
-    query = """SELECT * FROM datenspende.users WHERE user_id IN {0}""".format(user_ids)
+    query = """SELECT * FROM datenspende.users WHERE user_id = ANY(%(user_ids)s::integer[])"""
     
-    users = run_query(query)
+    users = run_query(query, {'user_ids': user_id_array(user_ids)})
     users.salutation = users.salutation.fillna(30.0)
 
     return users
 
 
+@profiling.instrument()
 def get_all_valid_datenspende_user():
-    
-    query = """SELECT DISTINCT user_id FROM datenspende.vitaldata"""
-    unique_users_vitals = run_query(query)
+    """
+    Get sex and age of all users of the data donation project that donated
+    vital data.
+
+    Users are matched with their vital data by a semi-join on the server, so
+    that neither the user ids in the vital data nor unused columns of the
+    user data are transferred. Users without salutation or birth date are
+    skipped.
 
-    query = """SELECT * FROM datenspende.users WHERE user_id IN {0}""".format(tuple(unique_users_vitals.user_id.values))
+    Returns:
+        pandas.DataFrame: The columns user_id, salutation, birth_date and age.
+    """
+    query = """
+    SELECT
+        users.user_id, users.salutation, users.birth_date
+    FROM
+        datenspende.users
+    WHERE
+        users.salutation IS NOT NULL AND
+        users.birth_date IS NOT NULL AND
+        EXISTS (SELECT 1 FROM datenspende.vitaldata WHERE vitaldata.user_id = users.user_id)
+    ORDER BY
+        users.user_id
+    """
     all_user = run_query(query)
-    
-    all_user = all_user.drop(columns=['source', 'creation_timestamp', 'height', 'weight', 'plz']).dropna()
+
     all_user['age'] = np.floor((2022 + 4 / 12) - all_user['birth_date'] + 2.5)
-    
-    all_user.reset_index(inplace=True, drop=True)
-    
+
     return all_user
\ No newline at end of file
@@ -1,12 +1,261 @@
-from long_covid import load_from_db
+from long_covid import load_from_db, profiling, schema
+from long_covid.dataset import write_partitioned
 from long_covid.surveydataIO import vaccinations, pcr_tests
+from datetime import datetime
+from functools import partial
 from pathlib import Path
+import argparse
+import json
+import time
+import numpy as np
 import pandas as pd
+import pyarrow as pa
 
 
 Path("data/01_raw").mkdir(parents=True, exist_ok=True)
 
-def main():
+MAX_DATE = "2022-04-03"
+MAX_CREATED_AT = 1649023200000
+
+VITALS_FILE = 'data/01_raw/vitals.feather'
+VITALS_DELTA_DIR = 'data/01_raw/vitals_delta'
+MANIFEST_FILE = 'data/01_raw/manifest.json'
+
+# Number of days before each user's last downloaded date that are fetched
+# again on each incremental update, since donations can arrive with a delay.
+# Data that arrives later than this is only picked up by a full refresh.
+REFRESH_DAYS = 7
+
+VITALS_KEY = ['userid', 'date', 'vitalid', 'deviceid']
+
+
+def write_vitals(user_ids, output_file, **kwargs):
+    """
+    Download vital data chunk by chunk and write it incrementally to a
+    feather file.
+
+    The file is written as an Arrow IPC file with one record batch per chunk
+    so that it can still be read with pandas.read_feather(), but the full
+    vital data is never held in memory at once.
+
+    Args:
+        user_ids (list/array of int): User ids for which to retrieve the vital data.
+        output_file (str): Path of the resulting feather file.
+        **kwargs: Passed on to load_from_db.iter_vitals().
+    """
+    writer = None
+    with profiling.stage('write_vitals') as record:
+        record['rows_out'] = 0
+        try:
+            for chunk in load_from_db.iter_vitals(user_ids, **kwargs):
+                batch = pa.RecordBatch.from_pandas(chunk, preserve_index=False)
+                if writer is None:
+                    writer = pa.ipc.new_file(output_file, batch.schema)
+                writer.write_batch(batch)
+                record['rows_out'] += len(chunk)
+
+            # Still write a valid (empty) file if there is no data at all
+            if writer is None:
+                empty = pa.Table.from_pandas(load_from_db._typed_vitals([]), preserve_index=False)
+                writer = pa.ipc.new_file(output_file, empty.schema)
+        finally:
+            if writer is not None:
+                writer.close()
+
+
+def load_manifest():
+    """
+    Load the manifest that records what was downloaded for each table.
+
+    Returns:
+        dict: The manifest. Empty if nothing was downloaded so far.
+    """
+    if not Path(MANIFEST_FILE).exists():
+        return {}
+
+    with open(MANIFEST_FILE) as infile:
+        return json.load(infile)
+
+
+def save_manifest(manifest):
+
+    with open(MANIFEST_FILE, 'w') as outfile:
+        json.dump(manifest, outfile, indent=4)
+
+
+def _record_batches(input_file, columns=None):
+    """
+    Read a feather file record batch by record batch.
+
+    Yields:
+        pandas.DataFrame: The rows of one record batch.
+    """
+    with pa.memory_map(str(input_file)) as source:
+        reader = pa.ipc.open_file(source)
+        for i in range(reader.num_record_batches):
+            batch = reader.get_batch(i)
+            if columns is not None:
+                batch = batch.select(columns)
+            yield batch.to_pandas()
+
+
+def last_dates(input_file):
+    """
+    Most recent date of vital data per user, read batch by batch.
+
+    Args:
+        input_file (str): Feather file with vital data.
+
+    Returns:
+        pandas.Series: The most recent date indexed by user id.
+    """
+    dates = [df.groupby('userid').date.max() for df in _record_batches(input_file, columns=['userid', 'date'])]
+    if not dates:
+        return pd.Series([], dtype='datetime64[ns]', name='date')
+
+    return pd.concat(dates).groupby(level=0).max()
+
+
+@profiling.instrument()
+def merge_vitals(user_ids, max_date):
+    """
+    Merge all downloaded deltas into the vital data and remove duplicates.
+
+    Deltas are applied in the order they were downloaded so that re-fetched
+    rows replace their earlier versions. Afterwards the delta files are
+    removed.
+
+    Only the key columns of the deltas are held in memory. The vital data
+    and the deltas are streamed batch by batch into a new file, which then
+    replaces VITALS_FILE.
+
+    Args:
+        user_ids (list/array of int): User ids of the current cohort. Data of all other users is dropped.
+        max_date (str): The maximum allowed date of vital data.
+    """
+    deltas = sorted(Path(VITALS_DELTA_DIR).glob('*.feather'))
+
+    keys = [pd.read_feather(delta, columns=VITALS_KEY) for delta in deltas]
+    delta_index = pd.MultiIndex.from_frame(pd.concat(keys, ignore_index=True)) if keys else None
+
+    # Of rows that were fetched several times only the last version is kept
+    last_version = ~delta_index.duplicated(keep='last') if keys else None
+
+    def valid(df):
+        return df.userid.isin(user_ids) & (df.date <= max_date)
+
+    temporary = Path(f'{VITALS_FILE}.tmp')
+    writer = None
+    try:
+        for df in _record_batches(VITALS_FILE):
+            keep = valid(df)
+            if delta_index is not None:
+                keep &= ~pd.MultiIndex.from_frame(df[VITALS_KEY]).isin(delta_index)
+            writer = _write_batch(writer, temporary, df[keep.values])
+
+        offset = 0
+        for delta in deltas:
+            for df in _record_batches(delta):
+                keep = last_version[offset:offset + len(df)] & valid(df).values
+                offset += len(df)
+                writer = _write_batch(writer, temporary, df[keep])
+    finally:
+        if writer is not None:
+            writer.close()
+
+    # Without any record batches there is nothing to replace
+    if writer is not None:
+        temporary.replace(VITALS_FILE)
+    for delta in deltas:
+        delta.unlink()
+
+
+def _write_batch(writer, output_file, df):
+    """
+    Append a data frame to an Arrow IPC file and open the file on the first call.
+
+    Returns:
+        pyarrow.ipc.RecordBatchFileWriter: The writer.
+    """
+    batch = pa.RecordBatch.from_pandas(df.reset_index(drop=True), preserve_index=False)
+    if writer is None:
+        writer = pa.ipc.new_file(str(output_file), batch.schema)
+    writer.write_batch(batch)
+
+    return writer
+
+
+@profiling.instrument()
+def update_vitals(user_ids, max_date=MAX_DATE, full_refresh=False, refresh_days=REFRESH_DAYS):
+    """
+    Download vital data incrementally.
+
+    The manifest stores the most recent downloaded date of each user (the
+    high-water mark). For users whose data was downloaded before only vital
+    data after their own mark minus refresh_days is downloaded. For all
+    other users (and users without any data so far) the full history is
+    downloaded. The new data is appended as a delta to VITALS_DELTA_DIR and
+    then merged into VITALS_FILE.
+
+    The vital data has no column that records when a row arrived in the
+    data base, so marks are based on the date of the data. Rows that arrive
+    more than refresh_days after a more recent date of the same user was
+    downloaded (e.g., from a second device that syncs late) are missed until
+    the next full refresh.
+
+    Args:
+        user_ids (list/array of int): User ids for which to retrieve the vital data.
+        max_date (str, optional): The maximum allowed date of vital data. Pins
+            the data for reproducibility. Defaults to MAX_DATE.
+        full_refresh (bool, optional): Discard all previous downloads. Defaults to False.
+        refresh_days (int, optional): Number of days before each user's mark
+            that are downloaded again. Defaults to REFRESH_DAYS.
+    """
+    manifest = load_manifest()
+    previous = manifest.get('vitals')
+
+    if full_refresh or previous is None or not Path(VITALS_FILE).exists():
+        print('Downloading full history of vital data...')
+        write_vitals(user_ids, VITALS_FILE, max_date=max_date)
+
+    else:
+        if 'last_dates' in previous:
+            marks = pd.Series(previous['last_dates'])
+            marks.index = marks.index.astype(np.int64)
+        else:
+            # Manifests of earlier versions only store a single mark
+            marks = pd.Series(previous['last_date'], index=np.asarray(previous['user_ids'], dtype=np.int64))
+
+        known_users = np.intersect1d(user_ids, marks.index.values)
+        new_users = np.setdiff1d(user_ids, known_users)
+
+        min_dates = (pd.to_datetime(marks[known_users]) - pd.Timedelta(days=refresh_days)).dt.strftime('%Y-%m-%d').values
+        print(
+            'Downloading vital data of', len(known_users), 'users after their last download minus', refresh_days,
+            'days and full history of', len(new_users), 'new users...'
+        )
+
+        Path(VITALS_DELTA_DIR).mkdir(parents=True, exist_ok=True)
+        timestamp = datetime.now().strftime('%Y%m%dT%H%M%S')
+        write_vitals(known_users, f'{VITALS_DELTA_DIR}/{timestamp}-0.feather', max_date=max_date, min_date=min_dates)
+        write_vitals(new_users, f'{VITALS_DELTA_DIR}/{timestamp}-1.feather', max_date=max_date)
+
+        merge_vitals(user_ids, max_date=max_date)
+
+    marks = last_dates(VITALS_FILE)
+    manifest['vitals'] = {
+        'last_date': max_date if marks.empty else marks.max().strftime('%Y-%m-%d'),
+        'last_dates': {str(user_id): date.strftime('%Y-%m-%d') for user_id, date in marks.items()},
+        'max_date': max_date,
+        'refresh_days': refresh_days,
+        'user_ids': [int(user_id) for user_id in user_ids],
+        'updated_at': datetime.now().isoformat(timespec='seconds')
+    }
+    save_manifest(manifest)
+
+
+@profiling.instrument('download')
+def main(full_refresh=False, partitioned=False, refresh_days=REFRESH_DAYS):
     """
     Load all raw input data.
 
@@ -17,22 +266,77 @@ def main():
     - User data
 
     All data is stored under data/raw/ for later preprocessing.    
+
+    Independent queries are run concurrently. Vital and user data depend on
+    the user ids in the survey data and are thus loaded in a second step.
+    Vital data is only downloaded incrementally, see update_vitals().
+
+    Args:
+        full_refresh (bool, optional): Download the full history of vital data. Defaults to False.
+        partitioned (bool, optional): Also store vital data as a partitioned
+            Parquet dataset in data/01_raw/vitals/. Defaults to False.
+        refresh_days (int, optional): Number of days before each user's last
+            download that are downloaded again. Defaults to REFRESH_DAYS.
     """
-    vacc = vaccinations(max_created_at=1649023200000)
-    tests = pcr_tests(max_created_at=1649023200000)
-    metadata = pd.merge(vacc, tests, on='user_id')
+    start = time.perf_counter()
 
-    vitals = load_from_db.get_vitals(metadata.user_id.unique())
-    users = load_from_db.get_user_data(metadata.user_id.unique())
+    results = load_from_db.run_concurrently({
+        'vaccinations': partial(vaccinations, max_created_at=MAX_CREATED_AT),
+        'PCR tests': partial(pcr_tests, max_created_at=MAX_CREATED_AT),
+        'all users': load_from_db.get_all_valid_datenspende_user
+    })
+    vacc = results['vaccinations']
+    tests = results['PCR tests']
+    metadata = pd.merge(vacc, tests, on='user_id')
 
     vacc.to_feather("data/01_raw/vaccinations.feather")
     tests.to_feather("data/01_raw/tests.feather")
-    
-    vitals.to_feather('data/01_raw/vitals.feather')
-    users.to_feather('data/01_raw/users.feather')
+    results['all users'].to_feather('data/01_raw/all_datenspende_users.feather')
+    print(f'Memory usage of vaccinations: {schema.memory_usage(vacc):.1f} MB, tests: {schema.memory_usage(tests):.1f} MB')
 
-    all_user = load_from_db.get_all_valid_datenspende_user()
-    all_user.to_feather('data/01_raw/all_datenspende_users.feather')
+    # Survey data is small and thus always downloaded in full
+    manifest = load_manifest()
+    for table in ('vaccinations', 'tests'):
+        manifest[table] = {'max_created_at': MAX_CREATED_AT, 'updated_at': datetime.now().isoformat(timespec='seconds')}
+    save_manifest(manifest)
+
+    user_ids = metadata.user_id.unique()
+    results = load_from_db.run_concurrently({
+        'vitals': partial(update_vitals, user_ids, full_refresh=full_refresh, refresh_days=refresh_days),
+        'users': partial(load_from_db.get_user_data, user_ids)
+    })
+    results['users'].to_feather('data/01_raw/users.feather')
+
+    if partitioned:
+        write_partitioned(pd.read_feather(VITALS_FILE), 'data/01_raw/vitals')
+
+    print(f'Downloaded all data in {time.perf_counter() - start:.1f} seconds')
+
+    setup_times = load_from_db.connection_setup_times()
+    print('Opened', len(setup_times), 'data base connections in', round(sum(setup_times), 2), 'seconds')
+
+    query_cache = load_from_db.query_cache_stats()
+    if query_cache is not None:
+        print('Query cache:', query_cache['hits'], 'hits,', query_cache['misses'], 'misses')
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Load all raw input data from the database.')
+    parser.add_argument('--full-refresh', action='store_true', help='download the full history of vital data')
+    parser.add_argument('--partitioned', action='store_true', help='also write vital data as a partitioned Parquet dataset')
+    parser.add_argument('--refresh-days', type=int, default=REFRESH_DAYS, help='days before the last download of each user that are downloaded again')
+    parser.add_argument('--query-cache', action='store_true', help='cache the results of survey and user queries on disk')
+    parser.add_argument('--trace-memory', action='store_true', help='record the peak memory of each stage with tracemalloc (slow)')
+    args = parser.parse_args()
+
+    if args.trace_memory:
+        profiling.trace_memory()
+
+    if args.query_cache:
+        load_from_db.enable_query_cache()
+
+    # Not run through the stage cache: the database is not hashed, so a cache
+    # key would not change with new donations. Vital data is updated
+    # incrementally instead (see update_vitals).
+    main(args.full_refresh, args.partitioned, args.refresh_days)
+
+    profiling.write_report('download')
@@ -1,15 +1,20 @@
 import pandas as pd
 from pathlib import Path
+import argparse
 import numpy as np
+import pyarrow as pa
+from long_covid import cache, dataset, profiling, schema
+from long_covid.dataset import write_partitioned
 
 Path("data/02_processed").mkdir(parents=True, exist_ok=True)
 
 
-def drop_apple_sleep(df):
+def drop_apple_sleep(df, verbose=True):
     """Remove apple users after 2021 October update that messes with sleep data.
 
     Args:
         df (pandas.DataFrame): The data frame containing the vital data.
+        verbose (bool, optional): Print the number of remaining users. Defaults to True.
 
     Returns:
         pandas.DataFrame: Vital data without corrupt apple data.
@@ -17,41 +22,233 @@ def drop_apple_sleep(df):
     # 
     invalid = (df.deviceid == 6) & (df.vitalid == 43) & (df.date >= '2021-10-20')
     df = df[~invalid]
-    print("Number of users after removing invalid apple users:", len(df.userid.unique()))
+    if verbose:
+        profiling.remaining("Number of users after removing invalid apple users:", len(df.userid.unique()))
 
     return df
 
 
-def normalize(df, by=['vitalid', 'date', 'deviceid']):
-    
-    norm = df.groupby(by)[['value']].mean().rename(columns={'value': 'daily_mean'})
-    norm.reset_index(inplace=True)
-    df = pd.merge(df, norm, on=by)
-    df['normalized_value'] = df['value'] - df['daily_mean']
-    df.rename(columns={'value': 'raw_value'}, inplace=True)
-    df.rename(columns={'normalized_value': 'value'}, inplace=True)
+@profiling.instrument()
+def normalize(df, by=['vitalid', 'date', 'deviceid'], method='mean', trim=0.1):
+    """
+    Subtract the daily average of all users with the same device from each
+    vital data point.
 
-    return df #.drop(columns='daily_mean') 
+    The daily average of each group is computed from factorized group codes
+    and broadcast back to all rows without merging, so that the vital data
+    is not copied.
 
+    Args:
+        df (pandas.DataFrame): The data frame containing the vital data.
+        by (list of str, optional): Columns that define a group. Defaults to ['vitalid', 'date', 'deviceid'].
+        method (str, optional): How to compute the daily average. Either
+            'mean', 'median' or 'trimmed' (mean of all values except the
+            fraction trim at both ends). Defaults to 'mean'.
+        trim (float, optional): Fraction of values to cut off at each end for method='trimmed'. Defaults to 0.1.
 
-def drop_devides_with_low_numbers(df):
+    Returns:
+        pandas.DataFrame: Vital data with the original value in raw_value, the
+        daily average in daily_mean and their difference in value.
+    """
+    codes = group_codes(df, by)
+
+    # Rows with missing group keys do not belong to any group
+    if (codes < 0).any():
+        df = df[codes >= 0]
+        codes = codes[codes >= 0]
+
+    values = df['value'].values
+    daily_mean = group_average(codes, values, method=method, trim=trim).astype(values.dtype)
+
+    df = df.rename(columns={'value': 'raw_value'}, copy=False)
+    df.index = pd.RangeIndex(len(df))
+    df['daily_mean'] = daily_mean
+    df['value'] = values - daily_mean
+
+    return schema.enforce(df, schema.VITALS_PROCESSED) #.drop(columns='daily_mean') 
+
+
+def group_codes(df, by):
+    """
+    Number the groups of a data frame defined by the combination of several
+    columns.
+
+    Cheaper in memory than DataFrame.groupby(by).ngroup() since each column
+    is factorized on its own and the codes are combined into a single
+    integer key.
+
+    Args:
+        df (pandas.DataFrame): The data.
+        by (list of str): Columns that define a group.
+
+    Returns:
+        numpy.ndarray: Group code of each row (integers from 0 to number of
+        groups - 1). Rows with missing values in any of the columns get -1.
+    """
+    key = np.zeros(len(df), dtype=np.int64)
+    missing = np.zeros(len(df), dtype=bool)
+
+    for column in by:
+        column_codes, uniques = pd.factorize(df[column])
+        missing |= column_codes < 0
+        key *= len(uniques)
+        key += column_codes
+
+    codes = pd.factorize(key)[0]
+    codes[missing] = -1
+
+    return codes
+
+
+def group_average(codes, values, method='mean', trim=0.1):
+    """
+    Average of values per group, broadcast back to each element.
+
+    Missing values are ignored.
+
+    Args:
+        codes (numpy.ndarray): Group code of each value (integers from 0 to number of groups - 1).
+        values (numpy.ndarray): The values.
+        method (str, optional): Either 'mean', 'median' or 'trimmed'. Defaults to 'mean'.
+        trim (float, optional): Fraction of values to cut off at each end for method='trimmed'. Defaults to 0.1.
+
+    Returns:
+        numpy.ndarray: The average of the group of each value.
+    """
+    valid = ~np.isnan(values)
+
+    if method == 'mean':
+        sums = np.bincount(codes, weights=np.where(valid, values, 0))
+        counts = np.bincount(codes, weights=valid)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return (sums / counts)[codes]
+
+    if method not in ('median', 'trimmed'):
+        raise ValueError("'method' must be either 'mean', 'median' or 'trimmed'")
+
+    # Sort by group and value. Missing values end up at the end of each group.
+    order = np.lexsort((values, codes))
+    sorted_codes = codes[order]
+    sorted_values = values[order].astype(np.float64)
+
+    counts = np.bincount(codes, weights=valid).astype(np.int64)
+    starts = np.concatenate([[0], np.cumsum(np.bincount(codes))[:-1]])
+    rank = np.arange(len(codes)) - starts[sorted_codes]
+
+    if method == 'median':
+        n = counts[sorted_codes]
+        middle = (rank == (n - 1) // 2) | (rank == n // 2)
+        average = np.bincount(sorted_codes[middle], weights=sorted_values[middle], minlength=len(counts))
+        average /= np.bincount(sorted_codes[middle], minlength=len(counts))
+    else:
+        cut = np.floor(trim * counts).astype(np.int64)
+        keep = (rank >= cut[sorted_codes]) & (rank < (counts - cut)[sorted_codes])
+        average = np.bincount(sorted_codes[keep], weights=sorted_values[keep], minlength=len(counts))
+        average /= np.bincount(sorted_codes[keep], minlength=len(counts))
+
+    return average[codes]
+
+
+def drop_devides_with_low_numbers(df, verbose=True):
 
-    print('Dropping some devices...')
     invalid = df.deviceid.isin([19, 46, 48])
     df = df[~invalid]
+    if verbose:
+        profiling.dropped(invalid.sum(), 'rows of devices with low numbers of users.')
 
     return df
 
 
-def preprocess_vital_data(input_file):
+@profiling.instrument()
+def preprocess_vital_data(input_file, partitioned=False):
 
-    df = pd.read_feather(input_file)
+    df = schema.enforce(pd.read_feather(input_file), schema.VITALS, label='raw vitals')
 
     df = drop_devides_with_low_numbers(df)
     df = drop_apple_sleep(df)
     df = normalize(df)
+    print(f'Memory usage of processed vitals: {schema.memory_usage(df):.1f} MB')
 
     df.to_feather('data/02_processed/vitals_processed.feather')
+    if partitioned:
+        write_partitioned(df, 'data/02_processed/vitals_processed')
+
+
+def _filtered_batches(input_file):
+    """
+    Read raw vital data record batch by record batch and drop invalid devices
+    and apple sleep data from each batch.
+    """
+    with pa.memory_map(input_file) as source:
+        reader = pa.ipc.open_file(source)
+        for i in range(reader.num_record_batches):
+            df = schema.enforce(reader.get_batch(i).to_pandas(), schema.VITALS)
+            df = drop_devides_with_low_numbers(df, verbose=False)
+            yield drop_apple_sleep(df, verbose=False)
+
+
+@profiling.instrument()
+def preprocess_vital_data_streaming(input_file, output_file, by=['vitalid', 'date', 'deviceid'], dataset_dir=None):
+    """
+    Same as preprocess_vital_data() but with memory usage independent of the
+    size of the input file.
+
+    The raw vital data is read one record batch at a time in two passes. The
+    first pass accumulates the sums and counts of values per group. The
+    second pass subtracts the resulting daily means and writes the output
+    batch by batch. Only the daily mean is supported as a normalization.
+
+    Args:
+        input_file (str): Feather file with raw vital data.
+        output_file (str): Feather file for the processed vital data.
+        by (list of str, optional): Columns that define a group for normalization. Defaults to ['vitalid', 'date', 'deviceid'].
+        dataset_dir (str, optional): If given, also write the processed vital
+            data as a partitioned Parquet dataset to this directory. Defaults to None.
+
+    Returns:
+        int: Number of rows written.
+    """
+    sums = None
+    users = np.array([], dtype=np.int64)
+
+    print('Dropping some devices...')
+    for df in _filtered_batches(input_file):
+        grouped = df.value.astype(np.float64).groupby([df[column] for column in by]).agg(['sum', 'count'])
+        sums = grouped if sums is None else sums.add(grouped, fill_value=0)
+        users = np.union1d(users, df.userid.unique())
+
+    profiling.remaining("Number of users after removing invalid apple users:", len(users))
+    daily_mean = sums['sum'] / sums['count']
+
+    n_rows = 0
+    writer = None
+    try:
+        for df in _filtered_batches(input_file):
+            index = daily_mean.index.get_indexer(pd.MultiIndex.from_frame(df[by]))
+
+            # Rows with missing group keys do not belong to any group
+            df = df[index >= 0]
+            index = index[index >= 0]
+
+            df = df.rename(columns={'value': 'raw_value'}, copy=False)
+            df.index = pd.RangeIndex(len(df))
+            df['daily_mean'] = daily_mean.values[index].astype(df.raw_value.dtype)
+            df['value'] = df.raw_value - df.daily_mean
+            df = schema.enforce(df, schema.VITALS_PROCESSED)
+
+            batch = pa.RecordBatch.from_pandas(df, preserve_index=False)
+            if writer is None:
+                writer = pa.ipc.new_file(output_file, batch.schema)
+            writer.write_batch(batch)
+
+            if dataset_dir is not None:
+                write_partitioned(df, dataset_dir, append=n_rows > 0)
+            n_rows += len(df)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    return n_rows
 
 
 def add_user_age(df):
@@ -60,6 +257,7 @@ def add_user_age(df):
     return df
 
 
+@profiling.instrument()
 def preprocess_user_data(input_file):
 
     df = pd.read_feather(input_file)
@@ -69,10 +267,40 @@ def preprocess_user_data(input_file):
     df.to_feather('data/02_processed/users_processed.feather')
 
 
-def main():
+@profiling.instrument('preprocess')
+def main(partitioned=False, streaming=False):
 
-    preprocess_vital_data('data/01_raw/vitals.feather')
+    if streaming:
+        preprocess_vital_data_streaming(
+            'data/01_raw/vitals.feather',
+            'data/02_processed/vitals_processed.feather',
+            dataset_dir='data/02_processed/vitals_processed' if partitioned else None
+        )
+    else:
+        preprocess_vital_data('data/01_raw/vitals.feather', partitioned=partitioned)
     preprocess_user_data('data/01_raw/users.feather')
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Clean and preprocess the raw input data.')
+    parser.add_argument('--partitioned', action='store_true', help='also write vital data as a partitioned Parquet dataset')
+    parser.add_argument('--streaming', action='store_true', help='process vital data batch by batch with constant memory')
+    parser.add_argument('--trace-memory', action='store_true', help='record the peak memory of each stage with tracemalloc (slow)')
+    cache.add_arguments(parser)
+    args = parser.parse_args()
+
+    if args.trace_memory:
+        profiling.trace_memory()
+
+    cache.run_cached(
+        'preprocess',
+        main,
+        kwargs={'partitioned': args.partitioned, 'streaming': args.streaming},
+        inputs=['data/01_raw/vitals.feather', 'data/01_raw/users.feather'],
+        outputs=['data/02_processed/vitals_processed.feather', 'data/02_processed/users_processed.feather']
+            + (['data/02_processed/vitals_processed'] if args.partitioned else []),
+        sources=[__file__, schema.__file__, dataset.__file__],
+        force=args.force,
+        budget=args.cache_budget * 2**30
+    )
+
+    profiling.write_report('preprocess')
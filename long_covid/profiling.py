@@ -0,0 +1,291 @@
+"""
+Lightweight instrumentation of the stages of the pipeline.
+
+Functions decorated with instrument() (or code run in a stage() block)
+record their wall time, CPU time, peak memory and the number of rows they
+receive and return. Filter steps record the number of remaining or dropped
+users with remaining() and dropped(), which also print them as before.
+
+All records of a run are collected in memory and written as a JSON run
+report with write_report(), e.g., to data/reports/compute_<timestamp>.json.
+
+Stages nest: a stage that starts while another one runs in the same thread
+records the name of the other one as its parent. Stages that run in worker
+processes are not recorded, but the CPU time and peak memory of finished
+worker processes count towards the stage that started them.
+
+tracemalloc only keeps a single peak per process. Stages that overlap with
+a stage in another thread, e.g., queries in load_from_db.run_concurrently(),
+are marked as concurrent and do not report traced memory.
+"""
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+from pathlib import Path
+import json
+import platform
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+import pandas as pd
+import pyarrow as pa
+
+
+REPORT_DIR = 'data/reports'
+
+# ru_maxrss is in kilobytes on Linux and in bytes on macOS
+RSS_UNIT = 1 if sys.platform == 'darwin' else 2**10
+
+_stages = []
+_attrition = []
+_lock = threading.Lock()
+_local = threading.local()
+_running = {}
+_started_at = datetime.now().isoformat(timespec='seconds')
+
+
+def trace_memory():
+    """
+    Also record the peak memory allocated by Python code (including numpy and
+    pandas buffers) with tracemalloc.
+
+    Tracing slows down allocations considerably and is therefore off by
+    default. Without it only the peak resident set size of the process is
+    recorded.
+    """
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def _rows(value):
+    """
+    Number of rows of a data frame, series or Arrow table. Counts the rows of
+    all such objects in tuples, lists and dicts. None for anything else.
+    """
+    if isinstance(value, (pd.DataFrame, pd.Series, pa.Table, pa.RecordBatch)):
+        return len(value)
+
+    if isinstance(value, dict):
+        value = list(value.values())
+
+    if isinstance(value, (tuple, list)):
+        counts = [count for count in map(_rows, value) if count is not None]
+        return sum(counts) if counts else None
+
+    return None
+
+
+def _active():
+
+    if not hasattr(_local, 'active'):
+        _local.active = []
+
+    return _local.active
+
+
+def _cpu_time():
+    """
+    CPU time of this process and all of its finished child processes.
+    """
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+
+def _peak_rss(who=resource.RUSAGE_SELF):
+
+    return resource.getrusage(who).ru_maxrss * RSS_UNIT / 2**20
+
+
+@contextmanager
+def stage(name, rows_in=None):
+    """
+    Record the resource usage of a block of code.
+
+    Args:
+        name (str): Name of the stage.
+        rows_in (int, optional): Number of input rows. Defaults to None.
+
+    Yields:
+        dict: The record of the stage. Set its key rows_out to report the
+        number of output rows.
+
+    Example:
+        with profiling.stage('load vitals') as record:
+            df = pd.read_feather(file)
+            record['rows_out'] = len(df)
+    """
+    active = _active()
+    record = {
+        'stage': name,
+        'parent': active[-1]['stage'] if active else None,
+        'thread': threading.current_thread().name,
+        'started_at': datetime.now().isoformat(timespec='milliseconds'),
+        'rows_in': rows_in,
+        'rows_out': None
+    }
+
+    # tracemalloc keeps a single peak per process. It is only reset by an
+    # outermost stage while no other thread runs a stage, so nested stages
+    # report the peak since their outermost stage started.
+    tracing = tracemalloc.is_tracing()
+    outermost = active[0] if active else record
+    if not active:
+        with _lock:
+            record['concurrent'] = bool(_running)
+            for other in _running.values():
+                other['concurrent'] = True
+            _running[id(record)] = record
+            if tracing and not record['concurrent']:
+                tracemalloc.reset_peak()
+    traced_start = tracemalloc.get_traced_memory()[0] if tracing else None
+
+    rss_start = _peak_rss()
+    wall_start = time.perf_counter()
+    cpu_start = _cpu_time()
+    thread_start = time.thread_time()
+
+    active.append(record)
+    try:
+        yield record
+    finally:
+        active.pop()
+        if not active:
+            with _lock:
+                del _running[id(record)]
+        record['concurrent'] = outermost['concurrent']
+
+        record['wall_seconds'] = time.perf_counter() - wall_start
+        record['cpu_seconds'] = _cpu_time() - cpu_start
+        record['thread_cpu_seconds'] = time.thread_time() - thread_start
+        record['peak_rss_mb'] = _peak_rss()
+        record['peak_rss_increase_mb'] = record['peak_rss_mb'] - rss_start
+        record['children_peak_rss_mb'] = _peak_rss(resource.RUSAGE_CHILDREN)
+        if tracing and tracemalloc.is_tracing() and not record['concurrent']:
+            current, peak = tracemalloc.get_traced_memory()
+            record['traced_peak_mb'] = peak / 2**20
+            record['traced_increase_mb'] = (current - traced_start) / 2**20
+
+        with _lock:
+            _stages.append(record)
+
+
+def instrument(name=None):
+    """
+    Decorator that records each call of a function as a stage.
+
+    The input rows are the rows of all data frames among the arguments, the
+    output rows those of all data frames in the return value.
+
+    Args:
+        name (str, optional): Name of the stage. Defaults to the name of the function.
+    """
+    def decorator(function):
+
+        stage_name = name or function.__qualname__
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(stage_name, rows_in=_rows(list(args) + list(kwargs.values()))) as record:
+                result = function(*args, **kwargs)
+                record['rows_out'] = _rows(result)
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def _attrition_record(kind, description, count):
+
+    active = _active()
+    record = {
+        'stage': active[-1]['stage'] if active else None,
+        'step': description,
+        kind: int(count)
+    }
+    with _lock:
+        _attrition.append(record)
+
+
+def remaining(description, count):
+    """
+    Print and record the number of users that remain after a filter step.
+
+    Args:
+        description (str): The filter step, e.g., 'Number of users after removal of unplausible values:'.
+        count (int): Number of remaining users.
+    """
+    print(description, count)
+    _attrition_record('remaining', description, count)
+
+
+def dropped(count, description):
+    """
+    Print and record the number of users that a filter step removes.
+
+    Prints 'Dropping <count> <description>'.
+
+    Args:
+        count (int): Number of dropped users (or rows).
+        description (str): Who is dropped, e.g., 'users with missing status.'.
+    """
+    print('Dropping', count, description)
+    _attrition_record('dropped', description, count)
+
+
+def report():
+    """
+    All records of this run.
+
+    Returns:
+        dict: Information on the run, the records of all stages in the order
+        in which they finished and all attrition records.
+    """
+    with _lock:
+        return {
+            'command': sys.argv,
+            'python': platform.python_version(),
+            'started_at': _started_at,
+            'finished_at': datetime.now().isoformat(timespec='seconds'),
+            'peak_rss_mb': _peak_rss(),
+            'stages': list(_stages),
+            'attrition': list(_attrition)
+        }
+
+
+def reset():
+    """
+    Remove all records, e.g., between two runs in a notebook.
+    """
+    global _started_at
+
+    with _lock:
+        _stages.clear()
+        _attrition.clear()
+        _started_at = datetime.now().isoformat(timespec='seconds')
+
+
+def write_report(name, report_dir=REPORT_DIR):
+    """
+    Write the run report to a JSON file.
+
+    Args:
+        name (str): Name of the run, e.g., 'compute'.
+        report_dir (str, optional): Directory of the reports. Defaults to REPORT_DIR.
+
+    Returns:
+        pathlib.Path: The file of the report, named after the run and the time it was written.
+    """
+    report_dir = Path(report_dir)
+    report_dir.mkdir(parents=True, exist_ok=True)
+
+    output_file = report_dir / f'{name}_{datetime.now():%Y%m%d_%H%M%S}.json'
+    with open(output_file, 'w') as outfile:
+        json.dump(report(), outfile, indent=2, default=str)
+
+    print('Wrote run report to', output_file)
+
+    return output_file
@@ -0,0 +1,184 @@
+"""
+On-disk cache for the results of SQL queries.
+
+Results are stored as Parquet files keyed by the normalized SQL text and the
+query parameters. Entries expire after a time to live and the least recently
+used entries are evicted once the cache exceeds its size limit.
+
+The cache is opt-in, see load_from_db.enable_query_cache().
+"""
+from pathlib import Path
+import hashlib
+import json
+import re
+import threading
+import time
+import pandas as pd
+import pyarrow as pa
+
+
+CACHE_DIR = 'data/.query_cache'
+INDEX_FILE = 'index.json'
+
+# Time to live in seconds and size limit in bytes
+TTL = 7 * 24 * 60 * 60
+MAX_BYTES = 5 * 2**30
+
+
+def normalize(query):
+    """
+    Collapse all whitespace in an SQL query so that queries that only differ
+    in formatting share a cache entry.
+    """
+    return re.sub(r'\s+', ' ', query).strip()
+
+
+def query_key(query, params=None):
+    """
+    Hash of the normalized query and its parameters.
+    """
+    digest = hashlib.sha256(normalize(query).encode())
+    digest.update(json.dumps(params, sort_keys=True, default=str).encode())
+
+    return digest.hexdigest()
+
+
+class QueryCache:
+    """
+    Cache of query results in a directory.
+
+    Safe to use from several threads, e.g., in load_from_db.run_concurrently().
+
+    Args:
+        path (str, optional): Directory of the cache. Defaults to CACHE_DIR.
+        ttl (float, optional): Seconds after which entries expire. Defaults to TTL.
+        max_bytes (int, optional): Size limit of the cache. Defaults to MAX_BYTES.
+    """
+
+    def __init__(self, path=CACHE_DIR, ttl=TTL, max_bytes=MAX_BYTES):
+
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._index = self._load_index()
+
+    def get(self, query, params=None):
+        """
+        Cached result of a query.
+
+        Returns:
+            pandas.DataFrame: The result or None if it is not cached or expired.
+        """
+        key = query_key(query, params)
+
+        with self._lock:
+            entry = self._index.get(key)
+            expired = entry is not None and time.time() - entry['created'] > self.ttl
+            if entry is None or expired or not (self.path / f'{key}.parquet').exists():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+
+            entry['last_used'] = time.time()
+            self._save_index()
+
+        # Read outside the lock so that threads can read concurrently. The
+        # entry may be evicted by put() in another thread in the meantime.
+        try:
+            df = pd.read_parquet(self.path / f'{key}.parquet')
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+
+        return df
+
+    def put(self, query, params, df):
+        """
+        Store the result of a query and evict entries beyond the size limit.
+        """
+        key = query_key(query, params)
+        target = self.path / f'{key}.parquet'
+
+        # Write to a temporary file so that readers never see partial results
+        temporary = self.path / f'{key}.{threading.get_ident()}.tmp'
+        try:
+            df.to_parquet(temporary)
+        except (pa.ArrowException, ValueError) as error:
+            print('Not caching query result that cannot be stored as Parquet:', error)
+            temporary.unlink(missing_ok=True)
+            return
+        temporary.replace(target)
+
+        with self._lock:
+            now = time.time()
+            self._index[key] = {'created': now, 'last_used': now, 'size': target.stat().st_size}
+            self._evict(keep=key)
+            self._save_index()
+
+    def stats(self):
+        """
+        Number of cache hits and misses so far.
+
+        Returns:
+            dict: hits, misses, number of entries and their size in bytes.
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self._index),
+                'bytes': sum(entry['size'] for entry in self._index.values())
+            }
+
+    def clear(self):
+        """
+        Remove all entries.
+        """
+        with self._lock:
+            for key in list(self._index):
+                self._remove(key)
+            self._save_index()
+
+    def _evict(self, keep=None):
+
+        now = time.time()
+        for key in [key for key, entry in self._index.items() if now - entry['created'] > self.ttl]:
+            self._remove(key)
+
+        total = sum(entry['size'] for entry in self._index.values())
+        for key in sorted(self._index, key=lambda key: self._index[key]['last_used']):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            total -= self._index[key]['size']
+            self._remove(key)
+
+    def _remove(self, key):
+
+        (self.path / f'{key}.parquet').unlink(missing_ok=True)
+        del self._index[key]
+
+    def _load_index(self):
+
+        try:
+            with open(self.path / INDEX_FILE) as infile:
+                return json.load(infile)
+        except FileNotFoundError:
+            return {}
+
+    def _save_index(self):
+
+        temporary = self.path / f'{INDEX_FILE}.tmp'
+        with open(temporary, 'w') as outfile:
+            json.dump(self._index, outfile)
+        temporary.replace(self.path / INDEX_FILE)
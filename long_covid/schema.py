@@ -0,0 +1,117 @@
+"""
+Compact column types for all tables of the pipeline.
+
+Each schema maps column names to the smallest dtype that holds the data.
+Columns that are not listed keep their dtype.
+"""
+import numpy as np
+
+
+VITALS = {'userid': 'int32', 'vitalid': 'int8', 'value': 'float32', 'deviceid': 'int16'}
+VITALS_PROCESSED = {**VITALS, 'raw_value': 'float32', 'daily_mean': 'float32'}
+TESTS = {'user_id': 'int32', 'test_result': 'category'}
+VACCINATIONS = {'user_id': 'int32', 'status': 'category'}
+WEEKLY_DEVIATIONS = {
+    'userid': 'int32', 'vitalid': 'int8', 'weeks_since_test': 'int8', 'test_result': 'category', 'vital_change': 'float32',
+    'cohort_mask': 'uint8'
+}
+USER_COHORTS = {'user_id': 'int32', 'cohort_mask': 'uint8'}
+
+# Bit i of the column cohort_mask is set for users in cohort COHORT_KEYS[i]
+COHORT_KEYS = ['positive', 'negative', 'unvaccinated', 'vaccinated', 'vaccinated_delta', 'vaccinated_omicron', 'total']
+
+
+def cohort_bits(*keys):
+    """
+    Bitmask of one or more cohorts.
+
+    Bit i of a cohort mask is set if the user belongs to cohort COHORT_KEYS[i].
+
+    Args:
+        *keys (str): Cohorts from COHORT_KEYS.
+
+    Returns:
+        int: The bitmask.
+    """
+    return sum(1 << COHORT_KEYS.index(key) for key in keys)
+
+
+def in_cohort(cohort_mask, *keys):
+    """
+    Select rows that belong to all of the given cohorts.
+
+    Args:
+        cohort_mask (pandas.Series or numpy.ndarray): Cohort masks, e.g., the
+            column cohort_mask of the weekly deviations.
+        *keys (str): Cohorts from COHORT_KEYS.
+
+    Returns:
+        numpy.ndarray: Boolean array that is True for rows in all cohorts.
+    """
+    bits = cohort_bits(*keys)
+
+    return (np.asarray(cohort_mask) & bits) == bits
+
+
+def enforce(df, schema, label=None):
+    """
+    Downcast the columns of a data frame to the dtypes given in a schema.
+
+    Args:
+        df (pandas.DataFrame): The data.
+        schema (dict): Maps column names to dtypes.
+        label (str, optional): If given, print the memory usage of the data
+            before and after downcasting under this label. Defaults to None.
+
+    Raises:
+        OverflowError: If values do not fit into the target dtype.
+        ValueError: If an integer column contains missing values.
+
+    Returns:
+        pandas.DataFrame: The data with downcast columns.
+    """
+    before = memory_usage(df)
+
+    for column, dtype in schema.items():
+        if column not in df.columns or df[column].dtype == dtype:
+            continue
+
+        if dtype != 'category':
+            _check_range(df[column], np.dtype(dtype), column)
+
+        df[column] = df[column].astype(dtype)
+
+    if label is not None:
+        print(f'Memory usage of {label}: {before:.1f} MB -> {memory_usage(df):.1f} MB')
+
+    return df
+
+
+def memory_usage(df):
+    """
+    Memory usage of a data frame in MB including the contents of object columns.
+    """
+    return df.memory_usage(deep=True).sum() / 1E6
+
+
+def _check_range(values, dtype, column):
+
+    if values.empty:
+        return
+
+    if np.issubdtype(dtype, np.integer):
+        if values.isna().any():
+            raise ValueError(f"Column '{column}' contains missing values and cannot be cast to {dtype}")
+        bounds = np.iinfo(dtype)
+    elif np.issubdtype(dtype, np.floating):
+        bounds = np.finfo(dtype)
+        values = values[np.isfinite(values)]
+        if values.empty:
+            return
+    else:
+        return
+
+    if values.min() < bounds.min or values.max() > bounds.max:
+        raise OverflowError(
+            f"Values of column '{column}' in [{values.min()}, {values.max()}] do not fit into {dtype}"
+        )
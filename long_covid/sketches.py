@@ -0,0 +1,254 @@
+"""
+Compact, mergeable summaries of the distribution of weekly deviations.
+
+For each cohort, vital and week compute.main stores
+
+- a histogram with fine fixed bins per vital that can be re-binned to any
+  coarser bins aligned with the fine bins (e.g., those of notebook 1.03) and
+- a quantile sketch with logarithmically spaced buckets (as in DDSketch)
+  whose quantiles have a relative error below a fixed accuracy (e.g., for
+  QQ plots as in notebook 1.10).
+
+Both are tables of counts in long format. Summaries of several weeks,
+cohorts or data sets are merged by adding the counts, see merge().
+compute.process_shards() builds them for each shard of users right after
+its deviations are computed and merges the summaries of all shards.
+"""
+import numpy as np
+import pandas as pd
+from scipy import stats
+from long_covid import profiling
+from long_covid.schema import COHORT_KEYS, in_cohort
+
+
+# First edge, last edge and width of the fine histogram bins per vital
+HISTOGRAM_BINS = {65: (-50, 50, 0.25), 9: (-30000, 30000, 50), 43: (-600, 600, 1)}
+
+RELATIVE_ACCURACY = 0.01
+
+# Values with a smaller magnitude are counted as zero by quantile sketches
+MIN_MAGNITUDE = 1E-3
+
+CELL = ['cohort', 'vitalid', 'weeks_since_test']
+
+
+def _by_cohort(df, key, cohort_keys):
+    """
+    Counts per cohort, vital, week and key, combined from the counts per
+    cohort mask.
+    """
+    grouped = df.groupby(['vitalid', 'weeks_since_test', 'cohort_mask', key]).size().rename('count').reset_index()
+
+    result = []
+    for cohort in cohort_keys:
+        counts = grouped[in_cohort(grouped.cohort_mask, cohort)]
+        counts = counts.groupby(['vitalid', 'weeks_since_test', key])['count'].sum().reset_index()
+        result.append(counts.assign(cohort=cohort))
+
+    result = pd.concat(result, ignore_index=True)
+
+    return result[CELL + [key, 'count']]
+
+
+@profiling.instrument()
+def histograms(df, cohort_keys=COHORT_KEYS, bins=HISTOGRAM_BINS, value='vital_change'):
+    """
+    Histograms with fine fixed bins per cohort, vital and week.
+
+    Bin i of a vital with bins (start, stop, width) counts the values in
+    [start + i * width, start + (i + 1) * width). Values below start are
+    counted in bin -1 and values at or above stop in bin (stop - start) / width.
+
+    Args:
+        df (pandas.DataFrame): Weekly deviations with the column cohort_mask.
+        cohort_keys (list of str, optional): Cohorts from schema.COHORT_KEYS. Defaults to all cohorts.
+        bins (dict, optional): Maps vitalid to (start, stop, width). Defaults to HISTOGRAM_BINS.
+        value (str, optional): Column with the values. Defaults to 'vital_change'.
+
+    Returns:
+        pandas.DataFrame: Non-zero counts with the columns cohort, vitalid,
+        weeks_since_test, bin and count.
+    """
+    df = df[df.vitalid.isin(list(bins))]
+    values = df[value].values.astype(np.float64)
+    vitalids = df.vitalid.values
+
+    start, stop, width = (np.array([bins[v][i] for v in vitalids], dtype=np.float64) for i in range(3))
+    n_bins = np.round((stop - start) / width)
+    index = np.clip(np.floor((values - start) / width), -1, n_bins)
+
+    binned = pd.DataFrame({
+        'vitalid': vitalids,
+        'weeks_since_test': df.weeks_since_test.values,
+        'cohort_mask': df.cohort_mask.values,
+        'bin': index.astype(np.int32)
+    })
+
+    return _by_cohort(binned, 'bin', cohort_keys)
+
+
+def rebin(histogram, edges, bins, clip=True):
+    """
+    Counts of a histogram from histograms() for coarser bins.
+
+    With clip=True the result is the same as clipping all values to
+    [edges[0], edges[-1]] followed by np.histogram(values, bins=edges), as in
+    notebook 1.03.
+
+    Args:
+        histogram (pandas.DataFrame): Rows of histograms() for a single vital,
+            e.g., all weeks 0 to 4 of one cohort. Counts of all rows are added.
+        edges (array): Bin edges. Must be aligned with the fine bins.
+        bins (tuple): (start, stop, width) of the fine bins of the vital.
+        clip (bool, optional): Count values beyond the edges in the first and
+            last bin. Defaults to True.
+
+    Returns:
+        numpy.ndarray: Counts per bin.
+    """
+    start, stop, width = bins
+    edges = np.asarray(edges, dtype=np.float64)
+
+    positions = (edges - start) / width
+    if not np.allclose(positions, np.round(positions)) or edges[0] < start or edges[-1] > stop:
+        raise ValueError('Edges must be aligned with the fine bins and lie within their range')
+    positions = np.round(positions).astype(np.int64)
+
+    counts = histogram.groupby('bin')['count'].sum()
+    fine = np.zeros(int(round((stop - start) / width)) + 2, dtype=np.int64)
+    fine[counts.index.values + 1] = counts.values
+    cumulative = np.concatenate([[0], np.cumsum(fine)])
+
+    # cumulative[i + 1] counts all values below the fine bin i
+    result = np.diff(cumulative[positions + 1])
+    if clip:
+        result[0] += cumulative[positions[0] + 1]
+        result[-1] += cumulative[-1] - cumulative[positions[-1] + 1]
+
+    return result
+
+
+def _bucket_parameters(relative_accuracy):
+
+    gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+    offset = 1 - int(np.floor(np.log(MIN_MAGNITUDE) / np.log(gamma)))
+
+    return gamma, offset
+
+
+@profiling.instrument()
+def quantile_sketches(df, cohort_keys=COHORT_KEYS, relative_accuracy=RELATIVE_ACCURACY, value='vital_change'):
+    """
+    Quantile sketches per cohort, vital and week.
+
+    Each value x is counted in the bucket sign(x) * (ceil(log_gamma |x|) + offset)
+    with gamma = (1 + a) / (1 - a) for relative accuracy a, so that every
+    quantile is known up to a relative error of a. Values with a magnitude
+    below MIN_MAGNITUDE are counted in bucket 0. Buckets are ordered like
+    the values they hold.
+
+    Args:
+        df (pandas.DataFrame): Weekly deviations with the column cohort_mask.
+        cohort_keys (list of str, optional): Cohorts from schema.COHORT_KEYS. Defaults to all cohorts.
+        relative_accuracy (float, optional): Relative accuracy of quantiles. Defaults to RELATIVE_ACCURACY.
+        value (str, optional): Column with the values. Defaults to 'vital_change'.
+
+    Returns:
+        pandas.DataFrame: Non-zero counts with the columns cohort, vitalid,
+        weeks_since_test, bucket and count.
+    """
+    gamma, offset = _bucket_parameters(relative_accuracy)
+
+    values = df[value].values.astype(np.float64)
+    magnitude = np.abs(values)
+    with np.errstate(divide='ignore'):
+        bucket = np.ceil(np.log(np.maximum(magnitude, MIN_MAGNITUDE)) / np.log(gamma)) + offset
+    bucket = np.where(magnitude < MIN_MAGNITUDE, 0, np.sign(values) * bucket)
+
+    bucketed = pd.DataFrame({
+        'vitalid': df.vitalid.values,
+        'weeks_since_test': df.weeks_since_test.values,
+        'cohort_mask': df.cohort_mask.values,
+        'bucket': bucket.astype(np.int32)
+    })
+
+    return _by_cohort(bucketed, 'bucket', cohort_keys)
+
+
+def merge(*summaries):
+    """
+    Merge histograms or quantile sketches by adding their counts.
+    """
+    df = pd.concat(summaries, ignore_index=True)
+    key = 'bin' if 'bin' in df.columns else 'bucket'
+
+    return df.groupby(CELL + [key], as_index=False)['count'].sum()
+
+
+def sorted_values(sketch, relative_accuracy=RELATIVE_ACCURACY):
+    """
+    Approximately sorted values of a quantile sketch.
+
+    Args:
+        sketch (pandas.DataFrame): Rows of quantile_sketches() for a single cell.
+        relative_accuracy (float, optional): As used for the sketch. Defaults to RELATIVE_ACCURACY.
+
+    Returns:
+        tuple: Representative value of each bucket in ascending order and the
+        number of values in each bucket.
+    """
+    gamma, offset = _bucket_parameters(relative_accuracy)
+
+    counts = sketch.groupby('bucket')['count'].sum().sort_index()
+    buckets = counts.index.values
+    magnitude = 2 * gamma ** (np.abs(buckets) - offset) / (gamma + 1)
+
+    return np.where(buckets == 0, 0, np.sign(buckets) * magnitude), counts.values
+
+
+def quantiles(sketch, q, relative_accuracy=RELATIVE_ACCURACY):
+    """
+    Quantiles of a quantile sketch.
+
+    Args:
+        sketch (pandas.DataFrame): Rows of quantile_sketches() for a single cell.
+        q (float or array): Probabilities between 0 and 1.
+        relative_accuracy (float, optional): As used for the sketch. Defaults to RELATIVE_ACCURACY.
+
+    Returns:
+        numpy.ndarray: The quantiles (lower quantile at rank q * (n - 1)).
+    """
+    values, counts = sorted_values(sketch, relative_accuracy)
+    ranks = np.floor(np.asarray(q) * (counts.sum() - 1))
+
+    return values[np.searchsorted(np.cumsum(counts), ranks, side='right')]
+
+
+def qq_points(sketch, relative_accuracy=RELATIVE_ACCURACY):
+    """
+    Points and fit of a normal probability plot from a quantile sketch.
+
+    Same as scipy.stats.probplot(values, dist='norm') for the values of a
+    cell up to the accuracy of the sketch, but without the raw values.
+
+    Args:
+        sketch (pandas.DataFrame): Rows of quantile_sketches() for a single cell.
+        relative_accuracy (float, optional): As used for the sketch. Defaults to RELATIVE_ACCURACY.
+
+    Returns:
+        tuple: ((theoretical quantiles, ordered values), (slope, intercept, r))
+    """
+    values, counts = sorted_values(sketch, relative_accuracy)
+    n = counts.sum()
+    ordered = np.repeat(values, counts)
+
+    # Filliben's estimate of the medians of the uniform order statistics, as in scipy.stats.probplot
+    medians = np.empty(n)
+    medians[-1] = 0.5 ** (1 / n)
+    medians[0] = 1 - medians[-1]
+    medians[1:-1] = (np.arange(2, n) - 0.3175) / (n + 0.365)
+    theoretical = stats.norm.ppf(medians)
+
+    slope, intercept, r = stats.linregress(theoretical, ordered)[:3]
+
+    return (theoretical, ordered), (slope, intercept, r)
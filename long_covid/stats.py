@@ -0,0 +1,423 @@
+"""
+Vectorized significance tests and resampling between user cohorts.
+
+The weekly deviations are grouped once into sufficient statistics per vital,
+week and cohort. Welch's t-tests and two-proportion z-tests for all weeks,
+vitals and pairs of cohorts are then computed from these statistics at once
+instead of filtering the data for every single test.
+
+The p-values are the same as those of scipy.stats.ttest_ind(equal_var=False)
+and statsmodels.stats.proportion.proportions_ztest.
+
+Bootstrap confidence intervals and permutation tests resample users and are
+spread across processes.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import warnings
+import numpy as np
+import pandas as pd
+from scipy import sparse, stats
+from long_covid.schema import COHORT_KEYS, cohort_bits, in_cohort
+
+
+# Thresholds for extreme vital changes per vital, see notebook 1.04
+EXTREME_THRESHOLDS = {65: ('>', 5), 9: ('<', -5000), 43: ('>', 60)}
+
+
+def exceedances(df, thresholds, value='vital_change'):
+    """
+    Flag values beyond a threshold that depends on the vital.
+
+    Args:
+        df (pandas.DataFrame): Data with the columns vitalid and value.
+        thresholds (dict): Maps vitalid to a tuple of comparison ('>' or '<')
+            and threshold, e.g., EXTREME_THRESHOLDS.
+        value (str, optional): Column with the values. Defaults to 'vital_change'.
+
+    Returns:
+        numpy.ndarray: True for values beyond the threshold of their vital.
+    """
+    values = df[value].values
+    vitalids = df.vitalid.values
+    extreme = np.zeros(len(df), dtype=bool)
+
+    for vitalid, (comparison, threshold) in thresholds.items():
+        if comparison not in ('>', '<'):
+            raise ValueError("Comparisons in 'thresholds' must be either '>' or '<'")
+        beyond = values > threshold if comparison == '>' else values < threshold
+        extreme |= (vitalids == vitalid) & beyond
+
+    return extreme
+
+
+def sufficient_statistics(df, cohort_keys=COHORT_KEYS, thresholds=None, value='vital_change'):
+    """
+    Number of values, their sum, the sum of squared deviations from their
+    mean and optionally the number of extreme values per vital, week and
+    cohort.
+
+    The data is grouped a single time by vital, week and cohort mask. The
+    statistics of each cohort are then combined from all masks that contain
+    the cohort.
+
+    Args:
+        df (pandas.DataFrame): Weekly deviations with the column cohort_mask.
+        cohort_keys (list of str, optional): Cohorts from schema.COHORT_KEYS. Defaults to all cohorts.
+        thresholds (dict, optional): If given, also count values beyond these
+            thresholds, see exceedances(). Defaults to None.
+        value (str, optional): Column with the values. Defaults to 'vital_change'.
+
+    Returns:
+        pandas.DataFrame: Statistics n, sum, m2 and (with thresholds) extreme
+        indexed by vitalid, weeks_since_test and cohort.
+    """
+    keys = [df.vitalid, df.weeks_since_test, df.cohort_mask]
+    values = df[value].astype(np.float64)
+
+    grouped = values.groupby(keys).agg(['count', 'sum', 'var']).rename(columns={'count': 'n'})
+    if thresholds is not None:
+        grouped['extreme'] = pd.Series(exceedances(df, thresholds, value), index=df.index).groupby(keys).sum()
+
+    # Sum of squared deviations from the mean of each group
+    grouped['m2'] = (grouped['var'] * (grouped.n - 1)).fillna(0)
+    grouped.drop(columns='var', inplace=True)
+
+    masks = grouped.index.get_level_values('cohort_mask').values
+    result = []
+    for key in cohort_keys:
+        cohort = grouped[(masks & cohort_bits(key)) > 0]
+        result.append(_combine(cohort.droplevel('cohort_mask')).assign(cohort=key))
+
+    result = pd.concat(result).set_index('cohort', append=True)
+
+    return result.astype({'n': np.int64, **({'extreme': np.int64} if thresholds is not None else {})})
+
+
+def _combine(grouped):
+    """
+    Combine statistics of groups with the same vital and week.
+
+    The sum of squared deviations is combined with the parallel algorithm of
+    Chan et al., which avoids the cancellation of sum(x**2) - sum(x)**2 / n
+    over the combined groups.
+    """
+    grouped = grouped[grouped.n > 0]
+    levels = ['vitalid', 'weeks_since_test']
+
+    combined = grouped.groupby(level=levels).sum()
+    mean = combined['sum'] / combined.n
+
+    offset = (grouped['sum'] / grouped.n).values - mean.reindex(grouped.index).values
+    combined['m2'] = (grouped.m2 + grouped.n * offset ** 2).groupby(level=levels).sum()
+
+    return combined
+
+
+def _paired(statistics, comparisons, columns):
+    """
+    Statistics of both cohorts of all comparisons as arrays of shape
+    (number of vitals and weeks, number of comparisons).
+    """
+    if statistics.empty:
+        # unstack() drops all columns of an empty frame
+        empty = np.empty((0, len(comparisons)))
+        return statistics.index.droplevel('cohort'), dict.fromkeys(columns, empty), dict.fromkeys(columns, empty)
+
+    wide = statistics.unstack('cohort')
+    first = [cohort for cohort, _ in comparisons]
+    second = [cohort for _, cohort in comparisons]
+
+    a = {column: wide[column].reindex(columns=first).values.astype(np.float64) for column in columns}
+    b = {column: wide[column].reindex(columns=second).values.astype(np.float64) for column in columns}
+
+    return wide.index, a, b
+
+
+def _alternatives(index, alternative, n_comparisons):
+    """
+    Alternative hypothesis of each test. alternative is either a single
+    alternative or a dict that maps vitalid to an alternative.
+    """
+    if isinstance(alternative, dict):
+        alternative = index.get_level_values('vitalid').map(alternative).values
+    else:
+        alternative = np.full(len(index), alternative, dtype=object)
+
+    return np.repeat(alternative[:, None], n_comparisons, axis=1)
+
+
+def _p_values(statistic, alternative, sf, cdf, greater, less):
+
+    p = np.full(statistic.shape, np.nan)
+    for name, values in ((greater, sf(statistic)), (less, cdf(statistic)), ('two-sided', 2 * sf(np.abs(statistic)))):
+        p = np.where(alternative == name, values, p)
+
+    unknown = set(np.unique(alternative)) - {greater, less, 'two-sided'}
+    if unknown:
+        raise ValueError(f"Unknown alternative(s) {unknown}. Use '{greater}', '{less}' or 'two-sided'")
+
+    return p
+
+
+def welch_ttest(statistics, comparisons, alternative='two-sided'):
+    """
+    Welch's t-test for the difference in mean between pairs of cohorts for
+    all vitals and weeks.
+
+    Same as scipy.stats.ttest_ind(a, b, equal_var=False, alternative=alternative)
+    for the values a and b of the first and second cohort of each comparison.
+
+    Args:
+        statistics (pandas.DataFrame): As returned by sufficient_statistics().
+        comparisons (list of tuple): Pairs of cohorts, e.g., [('unvaccinated', 'negative')].
+        alternative (str or dict, optional): 'two-sided', 'less' or 'greater',
+            or a dict that maps vitalid to one of them. Defaults to 'two-sided'.
+
+    Returns:
+        pandas.DataFrame: p-values indexed by vitalid and weeks_since_test
+        with one column '<cohort1>_<cohort2>' per comparison.
+    """
+    index, a, b = _paired(statistics, comparisons, ['n', 'sum', 'm2'])
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_a, mean_b = a['sum'] / a['n'], b['sum'] / b['n']
+        error_a = a['m2'] / (a['n'] - 1) / a['n']
+        error_b = b['m2'] / (b['n'] - 1) / b['n']
+
+        t = (mean_a - mean_b) / np.sqrt(error_a + error_b)
+        df = (error_a + error_b) ** 2 / (error_a ** 2 / (a['n'] - 1) + error_b ** 2 / (b['n'] - 1))
+
+    alternatives = _alternatives(index, alternative, len(comparisons))
+    p = _p_values(t, alternatives, lambda x: stats.t.sf(x, df), lambda x: stats.t.cdf(x, df), 'greater', 'less')
+
+    return pd.DataFrame(p, index=index, columns=[f'{first}_{second}' for first, second in comparisons])
+
+
+def proportions_ztest(statistics, comparisons, alternative='larger'):
+    """
+    Two-proportion z-test for the difference in the fraction of extreme
+    values between pairs of cohorts for all vitals and weeks.
+
+    Same as statsmodels.stats.proportion.proportions_ztest([count_a, count_b],
+    [n_a, n_b], alternative=alternative) with the pooled proportion as the
+    variance under the null hypothesis.
+
+    Args:
+        statistics (pandas.DataFrame): As returned by sufficient_statistics() with thresholds.
+        comparisons (list of tuple): Pairs of cohorts, e.g., [('unvaccinated', 'negative')].
+        alternative (str or dict, optional): 'two-sided', 'smaller' or
+            'larger', or a dict that maps vitalid to one of them. Defaults to 'larger'.
+
+    Returns:
+        pandas.DataFrame: p-values indexed by vitalid and weeks_since_test
+        with one column '<cohort1>_<cohort2>' per comparison.
+    """
+    index, a, b = _paired(statistics, comparisons, ['n', 'extreme'])
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        pooled = (a['extreme'] + b['extreme']) / (a['n'] + b['n'])
+        variance = pooled * (1 - pooled) * (1 / a['n'] + 1 / b['n'])
+        z = (a['extreme'] / a['n'] - b['extreme'] / b['n']) / np.sqrt(variance)
+
+    alternatives = _alternatives(index, alternative, len(comparisons))
+    p = _p_values(z, alternatives, stats.norm.sf, stats.norm.cdf, 'larger', 'smaller')
+
+    return pd.DataFrame(p, index=index, columns=[f'{first}_{second}' for first, second in comparisons])
+
+
+def _user_matrix(df, weeks, value='vital_change'):
+    """
+    Values of a cohort as sparse matrices of shape (number of users, number
+    of vitals and weeks) with the values and with ones where a user has a
+    value.
+    """
+    df = df[df.weeks_since_test.between(*weeks)]
+
+    if len(df) == 0:
+        empty = sparse.csr_matrix((0, 0))
+        return empty, empty, pd.MultiIndex.from_arrays([[], []], names=['vitalid', 'weeks_since_test'])
+
+    users, user_codes = np.unique(df.userid.values, return_inverse=True)
+    cells = pd.MultiIndex.from_arrays([df.vitalid.values, df.weeks_since_test.values], names=['vitalid', 'weeks_since_test'])
+    cell_codes, cell_index = cells.factorize(sort=True)
+
+    shape = (len(users), len(cell_index))
+    values = sparse.csr_matrix((df[value].values.astype(np.float64), (user_codes, cell_codes)), shape=shape)
+    present = sparse.csr_matrix((np.ones(len(df)), (user_codes, cell_codes)), shape=shape)
+
+    return values, present, pd.MultiIndex.from_tuples(cell_index, names=['vitalid', 'weeks_since_test'])
+
+
+def _bootstrap_batch(values, present, n_resamples, seed):
+    """
+    Means of all vitals and weeks for n_resamples multinomial resamples of
+    the users. Each resample draws the same users for all vitals and weeks.
+    """
+    rng = np.random.default_rng(seed)
+    n_users = values.shape[0]
+
+    # Without users there is nothing to resample
+    if n_users == 0:
+        return np.full((values.shape[1], n_resamples), np.nan)
+
+    weights = rng.multinomial(n_users, np.full(n_users, 1 / n_users), size=n_resamples).T
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (values.T @ weights) / (present.T @ weights)
+
+
+def _permutation_batch(values, present, n_first, n_permutations, seed):
+    """
+    Difference in mean between the first n_first users and all other users
+    for n_permutations random permutations of the users.
+    """
+    rng = np.random.default_rng(seed)
+    labels = np.zeros(values.shape[0])
+    labels[:n_first] = 1
+    first = rng.permuted(np.tile(labels, (n_permutations, 1)), axis=1).T
+    second = 1 - first
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (values.T @ first) / (present.T @ first) - (values.T @ second) / (present.T @ second)
+
+
+def _batches(n_resamples, batch_size, seed):
+    """
+    Sizes and seeds of all batches. The seeds only depend on seed and the
+    batch size, so results do not depend on the number of processes.
+    """
+    sizes = [min(batch_size, n_resamples - start) for start in range(0, n_resamples, batch_size)]
+
+    return sizes, np.random.SeedSequence(seed).spawn(len(sizes))
+
+
+def _run_batches(function, args, sizes, seeds, n_jobs):
+
+    if n_jobs == 1:
+        return [function(*args, size, seed) for size, seed in zip(sizes, seeds)]
+
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        futures = [executor.submit(function, *args, size, seed) for size, seed in zip(sizes, seeds)]
+        return [future.result() for future in futures]
+
+
+def bootstrap_aggregates(df, cohort_keys, limits=None, n_resamples=1000, confidence=0.95, seed=0, n_jobs=1, batch_size=100, first_week=-3, value='vital_change'):
+    """
+    Average weekly deviations per cohort with bootstrap confidence intervals.
+
+    Users are resampled with replacement (multinomial weights) within each
+    cohort. A resampled user contributes all of their weeks, so the
+    correlation between the weeks of a user is kept. Resamples are drawn in
+    batches that are spread across n_jobs processes. Each batch has its own
+    seed spawned from seed, so results are reproducible and independent of
+    n_jobs.
+
+    The result has the same shape as compute_aggregates() in notebook 1.02
+    with the additional statistics ci_low and ci_high (percentile intervals).
+
+    Args:
+        df (pandas.DataFrame): Weekly deviations with the column cohort_mask.
+        cohort_keys (list of str): Cohorts from schema.COHORT_KEYS.
+        limits (list of int, optional): Last week for each cohort. Defaults to 12 for all cohorts.
+        n_resamples (int, optional): Number of bootstrap resamples. Defaults to 1000.
+        confidence (float, optional): Confidence level of the intervals. Defaults to 0.95.
+        seed (int, optional): Seed of the random number generator. Defaults to 0.
+        n_jobs (int, optional): Number of processes. Defaults to 1.
+        batch_size (int, optional): Number of resamples per batch. Defaults to 100.
+        first_week (int, optional): First week. Defaults to -3.
+        value (str, optional): Column with the values. Defaults to 'vital_change'.
+
+    Returns:
+        pandas.DataFrame: Statistics mean, std, count, err, ci_low and
+        ci_high for each cohort, indexed by vitalid and weeks_since_test.
+    """
+    if limits is None:
+        limits = [12] * len(cohort_keys)
+
+    sizes, seeds = _batches(n_resamples, batch_size, seed)
+    alpha = (1 - confidence) / 2
+
+    result = []
+    for cohort_key, limit in zip(cohort_keys, limits):
+        cohort = df[in_cohort(df.cohort_mask, cohort_key)]
+        cohort = cohort[cohort.weeks_since_test.between(first_week, limit)]
+
+        agg = cohort.groupby(['vitalid', 'weeks_since_test'])[value].agg(['mean', 'std', 'count'])
+        agg['err'] = 1. * agg['std'] / np.sqrt(agg['count'])
+
+        values, present, cells = _user_matrix(cohort, (first_week, limit), value)
+        means = np.hstack(_run_batches(_bootstrap_batch, (values, present), sizes, seeds, n_jobs))
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            # nanquantile drops the axis of the quantiles if there are no cells
+            intervals = np.nanquantile(means, [alpha, 1 - alpha], axis=1).reshape(2, len(cells))
+        agg['ci_low'] = pd.Series(intervals[0], index=cells)
+        agg['ci_high'] = pd.Series(intervals[1], index=cells)
+
+        agg.columns = pd.MultiIndex.from_product([[cohort_key], agg.columns])
+        result.append(agg)
+
+    return pd.concat(result, axis=1)
+
+
+def permutation_test(df, comparisons, n_permutations=1000, alternative='two-sided', seed=0, n_jobs=1, batch_size=100, weeks=(-3, 12), value='vital_change'):
+    """
+    Permutation test for the difference in mean between pairs of cohorts for
+    all vitals and weeks.
+
+    The cohort labels are permuted at the level of users, i.e., all weeks of
+    a user keep the same label in each permutation. Permutations are spread
+    across processes like in bootstrap_aggregates().
+
+    Args:
+        df (pandas.DataFrame): Weekly deviations with the column cohort_mask.
+        comparisons (list of tuple): Pairs of disjoint cohorts, e.g., [('unvaccinated', 'negative')].
+        n_permutations (int, optional): Number of permutations. Defaults to 1000.
+        alternative (str or dict, optional): 'two-sided', 'less' or 'greater',
+            or a dict that maps vitalid to one of them. Defaults to 'two-sided'.
+        seed (int, optional): Seed of the random number generator. Defaults to 0.
+        n_jobs (int, optional): Number of processes. Defaults to 1.
+        batch_size (int, optional): Number of permutations per batch. Defaults to 100.
+        weeks (tuple, optional): First and last week. Defaults to (-3, 12).
+        value (str, optional): Column with the values. Defaults to 'vital_change'.
+
+    Returns:
+        pandas.DataFrame: p-values indexed by vitalid and weeks_since_test
+        with one column '<cohort1>_<cohort2>' per comparison.
+    """
+    sizes, seeds = _batches(n_permutations, batch_size, seed)
+
+    result = []
+    for first, second in comparisons:
+        a = df[in_cohort(df.cohort_mask, first)]
+        b = df[in_cohort(df.cohort_mask, second)]
+        n_first = len(np.unique(a[a.weeks_since_test.between(*weeks)].userid.values))
+
+        # Offset the user ids of the second cohort so that users of the first cohort come first
+        offset = int(df.userid.max()) + 1 if len(df) else 0
+        pooled = pd.concat([a, b.assign(userid=b.userid.astype(np.int64) + offset)])
+        values, present, cells = _user_matrix(pooled, weeks, value)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            labels = np.zeros((values.shape[0], 1))
+            labels[:n_first] = 1
+            observed = ((values.T @ labels) / (present.T @ labels) - (values.T @ (1 - labels)) / (present.T @ (1 - labels)))
+
+        differences = np.hstack(_run_batches(_permutation_batch, (values, present, n_first), sizes, seeds, n_jobs))
+        alternatives = _alternatives(cells, alternative, 1)
+
+        with np.errstate(invalid='ignore'):
+            counts = np.where(
+                alternatives == 'greater', (differences >= observed).sum(axis=1, keepdims=True),
+                np.where(
+                    alternatives == 'less', (differences <= observed).sum(axis=1, keepdims=True),
+                    (np.abs(differences) >= np.abs(observed)).sum(axis=1, keepdims=True)
+                )
+            )
+        p = (counts + 1) / (n_permutations + 1)
+        p[np.isnan(observed)] = np.nan
+
+        result.append(pd.Series(p[:, 0], index=cells, name=f'{first}_{second}'))
+
+    return pd.concat(result, axis=1)
@@ -2,11 +2,14 @@
 Methods for extracting survey data from the ROCS database.
 """
 from datetime import timedelta, datetime
-from long_covid.load_from_db import run_query
+from functools import partial
+from long_covid.load_from_db import run_query, run_concurrently
+from long_covid import profiling, schema
 import pandas as pd
 import numpy as np
 
 
+@profiling.instrument()
 def weekly_pcr_tests(max_created_at, drop_session_id=True):
 
     """
@@ -38,7 +41,7 @@ def weekly_pcr_tests(max_created_at, drop_session_id=True):
     seven-day period.
     """
 
-    query = f"""
+    query = """
     SELECT
         answers.user_id,
         choice.text,
@@ -50,10 +53,10 @@ def weekly_pcr_tests(max_created_at, drop_session_id=True):
     WHERE
         answers.question IN (91, 10) AND
         answers.created_at > 1634630400000 AND
-        answers.created_at < {max_created_at} AND
+        answers.created_at < %(max_created_at)s AND
         answers.element = choice.element
     """
-    df = run_query(query)
+    df = run_query(query, {'max_created_at': max_created_at})
 
     # Convert unix time step to datetime. The division ensures that times are
     # set to midnight
@@ -91,6 +94,7 @@ def weekly_pcr_tests(max_created_at, drop_session_id=True):
     return df
 
 
+@profiling.instrument()
 def one_off_pcr_tests(max_created_at):
 
     """
@@ -122,7 +126,7 @@ def one_off_pcr_tests(max_created_at):
     test.
     """
 
-    query = f"""
+    query = """
     SELECT
         answers.user_id,
         choice.text,
@@ -133,10 +137,10 @@ def one_off_pcr_tests(max_created_at):
     WHERE
         answers.question IN (83, 129) AND
         answers.created_at > 1634630400000 AND
-        answers.created_at < {max_created_at} AND
+        answers.created_at < %(max_created_at)s AND
         answers.element = choice.element
     """
-    df = run_query(query)
+    df = run_query(query, {'max_created_at': max_created_at})
 
     # Split dataframe in test-results and test-date
     df_results = df[df.question == 129].drop(columns='question')
@@ -161,13 +165,14 @@ def one_off_pcr_tests(max_created_at):
     df = df[df.test_result != 'nicht bekannt']
 
     # Reformat the date from an interval to the first day of the test week
-    df.test_date = [datetime.strptime(text[:10], '%d.%m.%Y') for text in df.test_date]
+    df.test_date = pd.to_datetime(df.test_date.str[:10], format='%d.%m.%Y')
 
     df.reset_index(inplace=True, drop=True)
 
     return df
 
 
+@profiling.instrument()
 def pcr_tests(max_created_at=1672527600000):
 
     """
@@ -203,9 +208,11 @@ def pcr_tests(max_created_at=1672527600000):
     period during which the test was taken.
     """
 
-    weekly_tests = weekly_pcr_tests(max_created_at=max_created_at)
-    one_off_tests = one_off_pcr_tests(max_created_at=max_created_at)
-    df = pd.concat([weekly_tests, one_off_tests])
+    results = run_concurrently({
+        'weekly PCR tests': partial(weekly_pcr_tests, max_created_at=max_created_at),
+        'one-off PCR tests': partial(one_off_pcr_tests, max_created_at=max_created_at)
+    })
+    df = pd.concat([results['weekly PCR tests'], results['one-off PCR tests']])
 
     # First sort by userid and date and keep the first positive AND first
     # negative PCR tests each
@@ -220,7 +227,7 @@ def pcr_tests(max_created_at=1672527600000):
 
     df.reset_index(inplace=True, drop=True)
 
-    return df
+    return schema.enforce(df, schema.TESTS)
 
 
 def _convert_date(date):
@@ -266,6 +273,139 @@ def _convert_date(date):
     return datetime.strptime(month + ' ' + year, '%B %Y')
 
 
+def _convert_dates(dates):
+    """
+    Convert a series of date strings to datetimes.
+
+    Same as dates.apply(_convert_date), but since there are only few distinct
+    date strings each of them is parsed only once.
+
+    Parameters:
+    -----------
+    dates : pandas.Series
+        Date strings (in german) of the format 'MONTH YEAR' or nan.
+
+    Returns:
+    --------
+    pandas.Series of datetimes with NaT for missing dates.
+    """
+    codes, uniques = pd.factorize(dates)
+
+    # Missing values have code -1 and thus map to the appended NaT
+    parsed = np.append(pd.to_datetime([_convert_date(date) for date in uniques]).values, np.datetime64('NaT', 'ns'))
+
+    return pd.Series(parsed[codes], index=dates.index, name=dates.name)
+
+
+VACCINATION_STATUS = {
+    'Ja': 'full',
+    'Nein, nur teilweise geimpft': 'partial',
+    'Nein, überhaupt nicht geimpft': 'unvaccinated',
+    'mit Auffrischimpfung (Booster)': 'booster',
+    'vollständig erstimunisiert (zweite Dosis im Fall von Moderna, Biontech, Astra Zeneca oder erste Impfdosis im Fall von Johnson&Johnson)': 'full',
+    'unvollständig erstimunisiert (nur erste Impfdosis im Fall von Moderna, Biontech, Astra Zeneca)': 'partial',
+    'gar nicht geimpft': 'unvaccinated'
+}
+
+
+def _vaccination_query(questionnaires, max_created_at):
+    """
+    SQL query for the vaccination data of one or more questionnaires.
+
+    The answers are pivoted on the server so that each questionnaire session
+    becomes one row with the columns status, first_dose, second_dose and
+    third_dose. Questions 121 and 134 ask about the status. 121 is only used
+    in questionnaire 10, 134 is used in questionaire 13 and has also replaced
+    121 in questionnaire 10 after December 2021. Questions 122, 130 and 136
+    ask for the dates of the first, second and third dose.
+
+    Due to a bug on thryve's end some users can submit data multiple times.
+    Even worse, they can even respond differently accross sessions. In that
+    case DISTINCT ON only keeps the last session of each user in each
+    questionnaire.
+
+    Parameters:
+    -----------
+    questionnaires : tuple of int
+        The ids of the questionnaires (10 and/or 13).
+
+    Returns:
+    --------
+    tuple of the query and the dict of its parameters. The result of the query
+    has one row per user and questionnaire.
+    """
+    params = {
+        'questionnaires': [int(questionnaire) for questionnaire in questionnaires],
+        'max_created_at': max_created_at
+    }
+
+    query = """
+    SELECT DISTINCT ON (answers.user_id, answers.questionnaire)
+        answers.user_id,
+        answers.questionnaire,
+        max(choice.text) FILTER (WHERE answers.question IN (121, 134)) AS status,
+        max(choice.text) FILTER (WHERE answers.question = 122) AS first_dose,
+        max(choice.text) FILTER (WHERE answers.question = 130) AS second_dose,
+        max(choice.text) FILTER (WHERE answers.question = 136) AS third_dose
+    FROM
+        datenspende.answers, datenspende.choice
+    WHERE
+        answers.question IN (121, 122, 130, 134, 136) AND
+        answers.created_at > 1634630400000 AND
+        answers.created_at < %(max_created_at)s AND
+        answers.element = choice.element AND
+        answers.questionnaire = ANY(%(questionnaires)s)
+    GROUP BY
+        answers.user_id, answers.questionnaire, answers.questionnaire_session
+    ORDER BY
+        answers.user_id, answers.questionnaire, answers.questionnaire_session DESC
+    """
+
+    return query, params
+
+
+def _vaccination_surveys(questionnaires, max_created_at):
+    """
+    Load vaccination data from one or both of the corresponding surveys with
+    a single query.
+
+    This helper function should not be called directly! Use vaccinations()
+    instead.
+
+    Parameters:
+    -----------
+    questionnaires : tuple of int
+        The ids of the questionnaires (10 and/or 13). 10 corresponds to the
+        test & symptons survey. 13 to the vaccination update survey that was
+        launched in December 2021.
+
+    Returns:
+    --------
+    dict that maps each questionnaire to a pandas.DataFrame of the format
+    described in _vaccination_one_survey().
+    """
+    print(f'Loading vaccination data from questionnaire(s) {", ".join(map(str, questionnaires))}...')
+
+    data = run_query(*_vaccination_query(questionnaires, max_created_at))
+
+    surveys = {}
+    for questionnaire in questionnaires:
+        df = data[data.questionnaire == questionnaire].drop(columns='questionnaire')
+
+        # Translate responses
+        df = df.assign(status=df.status.replace(VACCINATION_STATUS))
+
+        # Remove implausible responses
+        print(f'Questionnaire {questionnaire}:')
+        with profiling.stage(f'questionnaire {questionnaire}', rows_in=len(df)) as record:
+            df = _remove_implausible_responses(df)
+            record['rows_out'] = len(df)
+
+        surveys[questionnaire] = df.reset_index(drop=True)
+
+    return surveys
+
+
 def _vaccination_one_survey(questionnaire, max_created_at):
     """
     Load vaccination data from one of the two corresponding surveys.
@@ -298,63 +438,7 @@ def _vaccination_one_survey(questionnaire, max_created_at):
     If the parameter 'questionnaire' is 10 all entries in third_dose are NaN
     since that information is only surveyed in questionnaire 13.
     """
-
-    print(f'Loading vaccination data from questionnaire {questionnaire}...')
-
-    query = f"""
-    SELECT
-        answers.user_id,
-        choice.text,
-        answers.question,
-        answers.questionnaire_session
-    FROM
-        datenspende.answers, datenspende.choice
-    WHERE
-        answers.question IN (121, 122, 130, 134, 136) AND
-        answers.created_at > 1634630400000 AND
-        answers.created_at < {max_created_at} AND
-        answers.element = choice.element AND
-        answers.questionnaire = {questionnaire}
-    """
-
-    data = run_query(query)
-
-    # Create base data frame with the vaccination status of all users.
-    # Questions 121 and 134 ask about the status. 121 is only used in
-    # questionnaire 10, 134 is used in questionaire 13 and has also replaced
-    # 121 in questionnaire 10 after December 2021
-    df = data[data.question.isin((121, 134))].drop(columns='question')
-    df.rename(columns={'text': 'status'}, inplace=True)
-
-    # Create columns for first, second and third dose
-    for question_id, label in ((122, 'first_dose'), (130, 'second_dose'), (136, 'third_dose')):
-        dose_info = data[data.question == question_id].drop(columns='question')
-        df = pd.merge(df, dose_info, on=['user_id', 'questionnaire_session'], how='outer')
-        df.rename(columns={'text': label}, inplace=True)
-
-    # Due to a bug on thryve's end some users can submit data multiple
-    # times. Even worse, they can even respond differently accross sessions.
-    # In that case we only keep each last UNIQUE response of each user
-    df.sort_values(by=['user_id', 'questionnaire_session'], inplace=True)
-    df.drop_duplicates(subset='user_id', keep='last', inplace=True)
-    df.drop(columns='questionnaire_session', inplace=True)
-
-    # Translate responses
-    df.status.replace(
-        {'Ja': 'full',
-         'Nein, nur teilweise geimpft': 'partial',
-         'Nein, überhaupt nicht geimpft': 'unvaccinated',
-         'mit Auffrischimpfung (Booster)': 'booster',
-         'vollständig erstimunisiert (zweite Dosis im Fall von Moderna, Biontech, Astra Zeneca oder erste Impfdosis im Fall von Johnson&Johnson)': 'full',
-         'unvollständig erstimunisiert (nur erste Impfdosis im Fall von Moderna, Biontech, Astra Zeneca)': 'partial',
-         'gar nicht geimpft': 'unvaccinated'
-        }, inplace=True
-    )
-
-    # Remove implausible responses
-    df = _remove_implausible_responses(df)
-
-    return df.reset_index(drop=True)
+    return _vaccination_surveys((questionnaire,), max_created_at)[questionnaire]
 
 
 def _remove_implausible_responses(df):
@@ -397,7 +481,7 @@ def _remove_implausible_responses(df):
     for status, column in check:
         invalid = (df.status == status) & ~df[column].isna()
         if invalid.sum():
-            print('Dropping', invalid.sum(), status, 'that still provide', column)
+            profiling.dropped(invalid.sum(), f'{status} that still provide {column}')
             df = df[~invalid]
 
     check = [
@@ -412,13 +496,13 @@ def _remove_implausible_responses(df):
     for status, column in check:
         invalid = (df.status == status) & df[column].isna()
         if invalid.sum():
-            print('Dropping', invalid.sum(), status, 'with missing', column)
+            profiling.dropped(invalid.sum(), f'{status} with missing {column}')
             df = df[~invalid]
 
     # Remove users where status is missing
     invalid = df.status.isna()
     if invalid.sum():
-        print('Dropping', invalid.sum(), 'users with missing status.')
+        profiling.dropped(invalid.sum(), 'users with missing status.')
         df = df[~invalid]
 
 
@@ -427,10 +511,10 @@ def _remove_implausible_responses(df):
     # with Johnson & Johnson
     invalid = (df.status == 'booster') & df.second_dose.str.contains('Ich')
     if invalid.sum():
-        print('Dropping', invalid.sum(), 'users that are considered boostered despite not receiveing an official second dose.')
+        profiling.dropped(invalid.sum(), 'users that are considered boostered despite not receiveing an official second dose.')
         df = df[~invalid]
 
-    print(len(df), 'valid entries')
+    profiling.remaining('Number of valid entries:', len(df))
 
     return df
 
@@ -460,9 +544,10 @@ def _merged_vaccination_data(max_created_at):
            1221475     full      Mai 2021     Juli 2021            NaN
            1221479  booster     Juni 2021     Juli 2021  Dezember 2021
     """
-    # Load both surveys
-    initial = _vaccination_one_survey(questionnaire=10, max_created_at=max_created_at)
-    update = _vaccination_one_survey(questionnaire=13, max_created_at=max_created_at)
+    # Load both surveys in one query
+    surveys = _vaccination_surveys((10, 13), max_created_at=max_created_at)
+    initial = surveys[10]
+    update = surveys[13]
 
     print('Merging vaccination tables...')
 
@@ -478,19 +563,19 @@ def _merged_vaccination_data(max_created_at):
     # Filter out users with inconsistent responses accross surveys. See the
     # print statements for details.
     invalid = overlap.status_x.isin(['full', 'partial']) & (overlap.first_dose_x != overlap.first_dose_y)
-    print('Dropping', invalid.sum(), 'fully or partially vaccinated users with inconsistent response in first dose.')
+    profiling.dropped(invalid.sum(), 'fully or partially vaccinated users with inconsistent response in first dose.')
     overlap = overlap[~invalid]
 
     invalid = overlap.status_x.isin(['full']) & (overlap.second_dose_x != overlap.second_dose_y)
-    print('Dropping', invalid.sum(), 'fully vaccinated users with inconsistent response in second dose.')
+    profiling.dropped(invalid.sum(), 'fully vaccinated users with inconsistent response in second dose.')
     overlap = overlap[~invalid]
 
     invalid = overlap.status_x.isin(['full']) & overlap.status_y.isin(['partial', 'unvaccinated'])
-    print('Dropping', invalid.sum(), 'users that went from full to partial vaccination or unvaccinated.')
+    profiling.dropped(invalid.sum(), 'users that went from full to partial vaccination or unvaccinated.')
     overlap = overlap[~invalid]
 
     invalid = overlap.status_x.isin(['partial']) & overlap.status_y.isin(['unvaccinated'])
-    print('Dropping', invalid.sum(), 'users that went from partial vaccination to unvaccinated.')
+    profiling.dropped(invalid.sum(), 'users that went from partial vaccination to unvaccinated.')
     overlap = overlap[~invalid]
 
     # Once users are properly filtered, only keep information from survey 13
@@ -509,6 +594,7 @@ def _merged_vaccination_data(max_created_at):
     return final
 
 
+@profiling.instrument()
 def vaccinations(which='all', max_created_at=1672527600000):
     """
     Get vaccination data from the ROCS database.
@@ -582,17 +668,17 @@ def vaccinations(which='all', max_created_at=1672527600000):
     )
 
     # Convert datestrings to datetime
-    df.first_dose = df.first_dose.apply(_convert_date)
-    df.second_dose = df.second_dose.apply(_convert_date)
-    df.third_dose = df.third_dose.apply(_convert_date)
+    df.first_dose = _convert_dates(df.first_dose)
+    df.second_dose = _convert_dates(df.second_dose)
+    df.third_dose = _convert_dates(df.third_dose)
 
     # Remove users where the order of doses is incorrect
     for col1, col2 in (('first_dose', 'second_dose'), ('first_dose', 'third_dose'), ('second_dose', 'third_dose')):
         invalid = ~df[col1].isna() & ~df[col2].isna() & (df[col1] > df[col2])
-        print('Dropping', invalid.sum(), 'users where', col1, 'is larger than', col2)
+        profiling.dropped(invalid.sum(), f'users where {col1} is larger than {col2}')
         df = df[~invalid]
 
     # Sort for better readibility
     df.sort_values(by='user_id', inplace=True)
 
-    return df.reset_index(drop=True)
+    return schema.enforce(df.reset_index(drop=True), schema.VACCINATIONS)
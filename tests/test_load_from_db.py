@@ -0,0 +1,132 @@
+"""
+Streaming and incremental download of vital data against an in-memory
+sqlite stand-in for the data base.
+"""
+from contextlib import nullcontext
+from pathlib import Path
+import json
+import sqlite3
+import numpy as np
+import pandas as pd
+import pytest
+from long_covid import load_from_db, load_raw_data
+
+
+USERS = [1, 2, 3, 4, 5]
+DAYS = pd.date_range('2022-01-01', '2022-02-28')
+VITALS = [9, 43, 65]
+
+DTYPES = {
+    'userid': np.dtype('int32'),
+    'date': np.dtype('datetime64[ns]'),
+    'vitalid': np.dtype('int8'),
+    'value': np.dtype('float32'),
+    'deviceid': np.dtype('int16')
+}
+
+
+def insert(db, rows):
+
+    db.executemany('INSERT INTO datenspende.vitaldata VALUES (?, ?, ?, ?, ?)', rows)
+
+
+@pytest.fixture
+def db(monkeypatch):
+    """
+    The table datenspende.vitaldata with one value per user, day and vital.
+    Type 1 is not a vital of the study and must never be loaded.
+    """
+    db = sqlite3.connect(':memory:')
+    db.execute("ATTACH ':memory:' AS datenspende")
+    db.execute('CREATE TABLE datenspende.vitaldata (user_id, date, type, value, source)')
+    insert(db, [(user, str(day.date()), vital, float(user), 1) for user in USERS for day in DAYS for vital in VITALS + [1]])
+
+    monkeypatch.setattr(load_from_db, 'connection', lambda: nullcontext(db))
+    yield db
+    db.close()
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+
+    monkeypatch.chdir(tmp_path)
+    Path('data/01_raw').mkdir(parents=True)
+
+    return tmp_path
+
+
+def collect(**kwargs):
+
+    chunks = list(load_from_db.iter_vitals(USERS, max_date='2022-04-03', batch_size=2, chunk_size=100, **kwargs))
+    for chunk in chunks:
+        assert chunk.dtypes.to_dict() == DTYPES
+        assert len(chunk) <= 100
+
+    return pd.concat(chunks, ignore_index=True)
+
+
+def test_iter_vitals(db):
+
+    df = collect()
+
+    assert len(df) == len(USERS) * len(DAYS) * len(VITALS)
+    assert sorted(df.vitalid.unique()) == sorted(VITALS)
+    assert not df.duplicated(['userid', 'date', 'vitalid']).any()
+
+
+def test_iter_vitals_min_date(db):
+
+    df = collect(min_date='2022-02-20')
+
+    assert len(df) == len(USERS) * 8 * len(VITALS)
+    assert df.date.min() == pd.Timestamp('2022-02-21')
+
+
+def test_iter_vitals_min_date_per_user(db):
+
+    # User i only gets data after February 20 + i
+    min_dates = [f'2022-02-{20 + user}' for user in USERS]
+    df = collect(min_date=min_dates)
+
+    counts = df.groupby('userid').size()
+    assert counts.to_dict() == {user: (8 - user) * len(VITALS) for user in USERS}
+    assert (df.date > pd.to_datetime(df.userid.map(dict(zip(USERS, min_dates))))).all()
+
+
+def test_update_vitals(db, workdir):
+
+    # User 6 has no data yet
+    user_ids = np.array(USERS + [6])
+    load_raw_data.update_vitals(user_ids, max_date='2022-04-03')
+
+    df = pd.read_feather(load_raw_data.VITALS_FILE)
+    assert len(df) == len(USERS) * len(DAYS) * len(VITALS)
+
+    insert(db, [
+        (1, '2022-02-25', 9, 10.0, 2),   # within the refresh window of user 1
+        (1, '2022-02-10', 9, 10.0, 2),   # before the refresh window, missed until a full refresh
+        (2, '2022-03-05', 9, 20.0, 1),   # new data of user 2
+        (6, '2022-01-15', 9, 60.0, 1)    # first data of user 6
+    ])
+    db.execute("UPDATE datenspende.vitaldata SET value = 30 WHERE user_id = 3 AND date = '2022-02-27' AND type = 9")
+
+    load_raw_data.update_vitals(user_ids, max_date='2022-04-03')
+
+    df = pd.read_feather(load_raw_data.VITALS_FILE)
+    assert len(df) == len(USERS) * len(DAYS) * len(VITALS) + 3
+    assert not df.duplicated(load_raw_data.VITALS_KEY).any()
+    assert df.dtypes.to_dict() == DTYPES
+
+    def values(user, date):
+        return df[(df.userid == user) & (df.date == date) & (df.vitalid == 9)].value.tolist()
+
+    assert sorted(values(1, '2022-02-25')) == [1.0, 10.0]
+    assert values(1, '2022-02-10') == [1.0]
+    assert values(2, '2022-03-05') == [20.0]
+    assert values(3, '2022-02-27') == [30.0]
+    assert values(6, '2022-01-15') == [60.0]
+
+    with open(load_raw_data.MANIFEST_FILE) as infile:
+        last_dates = json.load(infile)['vitals']['last_dates']
+    assert last_dates['2'] == '2022-03-05' and last_dates['6'] == '2022-01-15'
+    assert not any(Path(load_raw_data.VITALS_DELTA_DIR).iterdir())
@@ -0,0 +1,49 @@
+"""
+Vectorized significance tests on small synthetic weekly deviations.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.stats import ttest_ind
+from long_covid import stats
+from long_covid.schema import cohort_bits
+
+
+COMPARISONS = [('unvaccinated', 'negative'), ('vaccinated', 'negative')]
+
+
+@pytest.fixture
+def deviations():
+
+    rng = np.random.default_rng(0)
+    n = 3000
+    masks = [cohort_bits('positive', 'unvaccinated'), cohort_bits('positive', 'vaccinated'), cohort_bits('negative')]
+
+    return pd.DataFrame({
+        'vitalid': rng.choice([9, 43, 65], n).astype(np.int8),
+        'weeks_since_test': rng.integers(-3, 4, n).astype(np.int8),
+        'vital_change': rng.normal(0, 10, n).astype(np.float32),
+        'cohort_mask': rng.choice(masks, n).astype(np.uint8)
+    })
+
+
+def test_welch_ttest(deviations):
+
+    p = stats.welch_ttest(stats.sufficient_statistics(deviations), COMPARISONS)
+
+    df = deviations[(deviations.vitalid == 65) & (deviations.weeks_since_test == 2)]
+    a = df[(df.cohort_mask & cohort_bits('unvaccinated')) > 0].vital_change.values
+    b = df[(df.cohort_mask & cohort_bits('negative')) > 0].vital_change.values
+
+    assert p.loc[(65, 2), 'unvaccinated_negative'] == pytest.approx(ttest_ind(a.astype(np.float64), b.astype(np.float64), equal_var=False)[1], rel=1E-9)
+
+
+def test_tests_without_data(deviations):
+
+    # No weeks pass the filter
+    statistics = stats.sufficient_statistics(deviations[deviations.weeks_since_test > 100], thresholds=stats.EXTREME_THRESHOLDS)
+
+    for p in (stats.welch_ttest(statistics, COMPARISONS), stats.proportions_ztest(statistics, COMPARISONS)):
+        assert p.empty
+        assert list(p.columns) == ['unvaccinated_negative', 'vaccinated_negative']
+        assert list(p.index.names) == ['vitalid', 'weeks_since_test']